@@ -0,0 +1,113 @@
+import gc
+import json
+import math
+import os
+import time
+import tracemalloc
+
+from docx import Document
+
+REGRESSION_THRESHOLD = 0.20  # Замедление больше чем на 20% считаем регрессией
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = max(0, math.ceil(fraction * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+def measure(name, func, iterations=50, warmup=3):
+    """Гоняет func и возвращает пропускную способность, перцентили задержки и пик памяти.
+
+    Пик памяти снимается отдельным прогоном под tracemalloc, чтобы трассировка
+    не искажала замеры времени.
+    """
+    for _ in range(warmup):
+        func()
+
+    gc.collect()
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        call_started = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - call_started)
+    elapsed = time.perf_counter() - started
+
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        'name': name,
+        'iterations': iterations,
+        'throughput': iterations / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'peak_memory_kb': peak / 1024,
+    }
+
+
+def make_synthetic_template(path, paragraphs, tables, placeholders):
+    """Шаблон заданного размера: абзацы и таблицы с плейсхолдерами, часть из них разбита на runs."""
+    keys = [f'{{{{FIELD_{index}}}}}' for index in range(placeholders)]
+    document = Document()
+    document.sections[0].header.paragraphs[0].text = f'Шапка {keys[0]}'
+    for index in range(paragraphs):
+        paragraph = document.add_paragraph(f'Абзац {index} с полем ')
+        key = keys[index % placeholders]
+        if index % 3 == 0:
+            # Как это делает Word: плейсхолдер оказывается в двух соседних runs
+            middle = len(key) // 2
+            paragraph.add_run(key[:middle]).bold = True
+            paragraph.add_run(key[middle:])
+        else:
+            paragraph.add_run(key)
+        paragraph.add_run(' и обычным текстом после него.')
+    for table_index in range(tables):
+        table = document.add_table(rows=10, cols=4)
+        for cell_index, cell in enumerate(table._cells):
+            cell.text = f'{keys[(table_index + cell_index) % placeholders]} ед.'
+    document.save(path)
+    return {key: f'значение {index}' for index, key in enumerate(keys)}
+
+
+def compare_with_baseline(results, baseline, threshold=REGRESSION_THRESHOLD):
+    """Строки сравнения с эталоном и список регрессий по p50."""
+    lines = []
+    regressions = []
+    for result in results:
+        reference = baseline.get(result['name'])
+        if not reference:
+            lines.append(f"{result['name']:<45} нет в эталоне")
+            continue
+        ratio = result['p50_ms'] / reference['p50_ms'] if reference['p50_ms'] else 1.0
+        marker = ''
+        if ratio > 1 + threshold:
+            marker = '  РЕГРЕССИЯ'
+            regressions.append(result['name'])
+        lines.append(f"{result['name']:<45} p50 {reference['p50_ms']:8.2f} -> {result['p50_ms']:8.2f} ms ({ratio:5.2f}x){marker}")
+    return lines, regressions
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as baseline_file:
+        return {result['name']: result for result in json.load(baseline_file)}
+
+
+def save_baseline(path, results):
+    with open(path, 'w', encoding='utf-8') as baseline_file:
+        json.dump(results, baseline_file, ensure_ascii=False, indent=2)
+
+
+def format_result(result):
+    return (f"{result['name']:<45} {result['throughput']:9.1f}/s  p50 {result['p50_ms']:8.2f}  "
+            f"p95 {result['p95_ms']:8.2f}  p99 {result['p99_ms']:8.2f} ms  peak {result['peak_memory_kb']:9.0f} KB")
@@ -0,0 +1,181 @@
+"""Бенчмарки движка документов и горячих маршрутов.
+
+Запуск из каталога Проект:
+    python -m Benchmarks.run                  # все сценарии и сравнение с эталоном
+    python -m Benchmarks.run --save-baseline  # сохранить текущие результаты как эталон
+    python -m Benchmarks.run --only documents --iterations 200
+
+Эталон Benchmarks/baseline.json лежит в репозитории и пересобирается командой
+    python -m Benchmarks.run --save-baseline --iterations 200
+в том же коммите, что и намеренное изменение производительности. Время
+зависит от машины: на другом железе сначала сохраните эталон с базовой
+ветки (--baseline /tmp/base.json --save-baseline), затем сравните с ним ветку.
+"""
+import argparse
+import glob
+import itertools
+import os
+import shutil
+import sys
+import tempfile
+
+from Benchmarks.bench import (
+    REGRESSION_THRESHOLD, compare_with_baseline, format_result, load_baseline,
+    make_synthetic_template, measure, save_baseline,
+)
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEMPLATES = os.path.join(PROJECT_ROOT, 'Templates')
+DEFAULT_BASELINE = os.path.join(PROJECT_ROOT, 'Benchmarks', 'baseline.json')
+
+# (имя, абзацев, таблиц, плейсхолдеров)
+SYNTHETIC_SIZES = (
+    ('small', 50, 2, 10),
+    ('medium', 500, 10, 40),
+    ('large', 3000, 40, 120),
+)
+
+
+def document_benchmarks(workdir, iterations):
+    from Services.document_service import invalidate_template, process_document
+    from Services.render_cache import RENDER_CACHE_BYTES, configure_render_cache
+
+    # Движок меряем без кэша готовых документов: иначе все итерации после первой - поиск в словаре
+    configure_render_cache(0)
+    placeholders = {'ФИО': 'Иванов Иван Иванович', 'ХХХ': '469 200', 'ххх': '469 200'}
+    results = []
+    for path in sorted(glob.glob(os.path.join(TEMPLATES, '*.docx')), key=lambda p: int(os.path.basename(p)[:-5])):
+        name = f'process_document[{os.path.basename(path)}]'
+        results.append(measure(name, lambda path=path: process_document(path, placeholders), iterations))
+
+    # Холодный рендер: каждый раз с разбором .docx с диска
+    cold_path = os.path.join(TEMPLATES, '1.docx')
+
+    def cold_render():
+        invalidate_template(cold_path)
+        process_document(cold_path, placeholders)
+
+    results.append(measure('process_document[1.docx, cold]', cold_render, iterations))
+
+    for size, paragraphs, tables, count in SYNTHETIC_SIZES:
+        path = os.path.join(workdir, f'synthetic_{size}.docx')
+        values = make_synthetic_template(path, paragraphs, tables, count)
+        results.append(measure(f'process_document[synthetic {size}]',
+                               lambda path=path, values=values: process_document(path, values),
+                               max(5, iterations // (10 if size == 'large' else 1))))
+
+    configure_render_cache(RENDER_CACHE_BYTES)
+    results.append(measure('process_document[1.docx, render cache hit]',
+                           lambda: process_document(cold_path, placeholders), iterations))
+    return results
+
+
+def route_benchmarks(workdir, iterations):
+    # Приложение работает с копией БД во временном каталоге, рабочая БД не трогается
+    database = os.path.join(workdir, 'db.db')
+    shutil.copy(os.path.join(PROJECT_ROOT, 'DB', 'db.db'), database)
+    os.environ['DATABASE_URL'] = 'sqlite:///' + database
+    os.chdir(workdir)
+
+    from Document_api import create_app, db, init_db
+    from Document_api.models import Doctype, DocTemp, Employees, LegalEntities, Users
+
+    app = create_app()
+    init_db(app)
+
+    with app.app_context():
+        user = Users(username='bench')
+        user.set_password('bench')
+        db.session.add(user)
+        db.session.merge(LegalEntities(name='ООО «Бенч»', director='Иванов И.И.'))
+        db.session.merge(Doctype(type='Акт'))
+        db.session.add(DocTemp(compName='ООО «Бенч»', docType='Акт', link=os.path.join(TEMPLATES, '1.docx')))
+        db.session.merge(Employees(employee='Бенч', rate=1500))
+        db.session.commit()
+
+    client = app.test_client()
+    token = client.post('/login', auth=('bench', 'bench')).get_json()['token']
+    headers = {'Authorization': f'Bearer {token}'}
+
+    def post(url, payload):
+        def call():
+            # Закрытие ответа, как это делает WSGI-сервер, освобождает слот лимитера
+            with client.post(url, json=payload() if callable(payload) else payload, headers=headers) as response:
+                assert response.status_code < 400, (url, response.status_code, response.get_data(as_text=True))
+        return call
+
+    document = {
+        'template_path': os.path.join(TEMPLATES, '1.docx'),
+        'placeholders': {'ФИО': 'Иванов Иван Иванович', 'ХХХ': '469 200'},
+        'sum': 469200,
+        'legalEntities': 'ООО «Бенч»',
+        'signatories': 'Иванов И.И.',
+        'date': '2025-01-31',
+    }
+    # Суммы зарплаты уходят клиентам JSON-числами, а не строками Decimal
+    with client.post('/calculate_salary', json={'employee': 'Бенч', 'hours': '168'}, headers=headers) as response:
+        salary = response.get_json()
+        assert all(isinstance(salary[key], (int, float)) for key in ('salary_before_vat', 'vat_rate', 'vat_amount', 'salary_with_vat')), salary
+
+    numbers = itertools.count()
+
+    def uncached(document):
+        # Новое ФИО на каждый вызов, чтобы рендер не отдавался из кэша готовых документов
+        return lambda: dict(document, placeholders=dict(document['placeholders'], ФИО=f'Иванов {next(numbers)}'))
+
+    results = [
+        measure('POST /get_template', post('/get_template', {'document_type': 'акт', 'company_name': 'ООО «Бенч»'}), iterations),
+        measure('POST /process_document', post('/process_document', uncached(document)), iterations),
+        measure('POST /process_document (file)', post('/process_document', uncached(dict(document, response_mode='file'))), iterations),
+        measure('POST /process_document (render cache hit)', post('/process_document', document), iterations),
+        measure('POST /calculate_salary', post('/calculate_salary', {'employee': 'Бенч', 'hours': '168'}), iterations),
+        measure('POST /working_days', post('/working_days', {'year': 2025, 'month': 1}), iterations),
+    ]
+    # Файловые ответы (send_file) должны возвращать слоты: иначе после RENDER_CONCURRENCY вызовов все получают 503
+    limiter_stats = app.extensions['render_limiter'].stats()
+    assert limiter_stats['active'] == 0, ('render slots leaked', limiter_stats)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--only', choices=('documents', 'routes'))
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD)
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='bench_')
+    cwd = os.getcwd()
+    try:
+        results = []
+        if args.only in (None, 'documents'):
+            results += document_benchmarks(workdir, args.iterations)
+        if args.only in (None, 'routes'):
+            results += route_benchmarks(workdir, args.iterations)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    for result in results:
+        print(format_result(result))
+
+    if args.save_baseline:
+        save_baseline(args.baseline, results)
+        print(f'Эталон сохранен в {args.baseline}')
+        return 0
+
+    baseline = load_baseline(args.baseline)
+    if baseline is None:
+        print('Эталон не найден, сравнение пропущено (запустите с --save-baseline)')
+        return 0
+
+    lines, regressions = compare_with_baseline(results, baseline, args.threshold)
+    print()
+    print('\n'.join(lines))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
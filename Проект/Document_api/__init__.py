@@ -1,16 +1,110 @@
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from .config import Config
+from Services.storage import configure_engine
+from Services.metrics import instrument_app
+from Services.render_cache import configure_render_cache
+from Services.admission import AdmissionLimiter
 import os
 
-app = Flask(__name__)
-app.config.from_object(Config)
+db = SQLAlchemy()
 
-db = SQLAlchemy(app)
 
-# Импортируем routes после инициализации app и db, чтобы избежать circular imports
-from . import routes, models
+def create_app(config=Config):
+    """Фабрика приложения: импорт пакета больше ничего не создает и не трогает БД.
 
-# Создаем директорию для загрузки файлов, если ее нет
-if not os.path.exists(app.config['UPLOAD_FOLDER']):
-    os.makedirs(app.config['UPLOAD_FOLDER'])
+    Схема и начальные данные создаются отдельно через init_db (или
+    `flask --app Document_api init-db`). Если задан WARM_UP, шаблоны
+    загружаются сразу - при gunicorn --preload это происходит до fork,
+    и воркеры делят их память copy-on-write. SHARD_DIR включает
+    раздельные файлы партнеров (enable_sharding).
+    """
+    app = Flask(__name__)
+    app.config.from_object(config)
+
+    db.init_app(app)
+    configure_render_cache(app.config['RENDER_CACHE_BYTES'], app.config['RENDER_CACHE_DIR'])
+    # Рендеринг ограничен отдельно, чтобы дешевые маршруты не ждали за python-docx
+    app.extensions['render_limiter'] = AdmissionLimiter(
+        'render', app.config['RENDER_CONCURRENCY'], app.config['RENDER_QUEUE_SIZE'],
+        app.config['RENDER_QUEUE_TIMEOUT'], app.config['RENDER_PER_USER'],
+    )
+
+    with app.app_context():
+        configure_engine(db.engine)  # WAL, busy_timeout и прочие PRAGMA для каждого соединения
+        instrument_app(app, db.engine, app.config['SLOW_REQUEST_MS'], app.config['PROFILE_SAMPLE_RATE'])
+
+    # Импортируем routes внутри фабрики, чтобы избежать circular imports
+    from . import routes  # routes импортирует и models
+    app.register_blueprint(routes.bp)
+
+    if app.config['SHARD_DIR']:
+        enable_sharding(app)
+
+    @app.cli.command('init-db')
+    def init_db_command():
+        """Создает таблицы, индексы и настройки по умолчанию."""
+        init_db(app)
+        print('Database initialized')
+
+    # Создаем директорию для загрузки файлов, если ее нет
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+
+    if app.config['WARM_UP']:
+        warm_up(app)
+    return app
+
+
+def init_db(app):
+    """Явный шаг инициализации: схема, недостающие колонки, сводка, поисковый индекс, Settings."""
+    from .models import Settings
+    from Services.storage import add_missing_columns
+    from Services.report_service import ensure_summary
+    from Services.search_service import ensure_search_index
+
+    with app.app_context():
+        db.create_all()
+        add_missing_columns(db.engine, db.metadata)
+        ensure_summary(db.engine)
+        ensure_search_index(db.engine)
+        if 'shard_router' in app.extensions:
+            app.extensions['shard_router'].init_catalog()
+
+        if not Settings.query.first():  # Проверяем, есть ли уже настройки
+            db.session.add(Settings(vat_rate=0.05))  # Создаем настройки по умолчанию
+            db.session.commit()
+
+
+def enable_sharding(app):
+    """DocTemp и ReadyDoc каждого юрлица - в своем файле SHARD_DIR, основная БД - каталог.
+
+    db.session переключается на RoutedSession, поэтому маршруты о шардах не
+    знают. Сессия у db общая для процесса, как и движок.
+    """
+    from Services.sharding import ShardRouter, route_sessions
+
+    with app.app_context():
+        router = ShardRouter(db.engine, app.config['SHARD_DIR'], db.metadata)
+    app.extensions['shard_router'] = router
+    route_sessions(db.session.session_factory, router)
+
+
+def warm_up(app):
+    """Заранее загружает python-docx, шаблоны из DocTemp и календарь текущего года."""
+    import datetime
+    from .models import DocTemp
+    from Services.calendar_service import production_calendar
+    from Services.document_service import TEMPLATE_CACHE_SIZE, get_compiled_template
+
+    with app.app_context():
+        links = db.session.scalars(
+            db.select(DocTemp.link).where(DocTemp.link.is_not(None)).order_by(DocTemp.id.desc()).limit(TEMPLATE_CACHE_SIZE)
+        ).all()
+    for link in links:
+        if link.endswith('.docx') and os.path.isfile(link):
+            try:
+                get_compiled_template(link)
+            except Exception:
+                app.logger.warning('Failed to warm up template %s', link, exc_info=True)
+
+    production_calendar.year(datetime.date.today().year)
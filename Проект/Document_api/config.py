@@ -1,10 +1,29 @@
 import os
+from Services.auth_service import load_secret_key
+from Services.storage import DATABASE_URL, engine_options
+from Services.sharding import SHARD_DIR
 
 class Config:
-    SECRET_KEY = os.environ.get('SECRET_KEY') or 'you-will-never-guess'
-    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///../DB/db.db'
+    SECRET_KEY = load_secret_key() # SECRET_KEY или ключ развертывания из DB/secret_key, см. Services/auth_service.py
+    SQLALCHEMY_DATABASE_URI = DATABASE_URL # Общий с main.py файл БД, см. Services/storage.py
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(DATABASE_URL)
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     UPLOAD_FOLDER = './Ready_doc'
     ALLOWED_EXTENSIONS = {'docx', 'pdf', 'txt'}
     APP_ROOT = os.path.dirname(os.path.abspath(__file__)) # Явно указываем корень приложения
+    RENDER_WORKERS = int(os.environ.get('RENDER_WORKERS') or os.cpu_count() or 1) # Процессы для пакетного рендеринга
+    BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS') or 1000) # Максимум документов в одном пакете
+    SLOW_REQUEST_MS = float(os.environ['SLOW_REQUEST_MS']) if os.environ.get('SLOW_REQUEST_MS') else None # Порог для лога медленных запросов
+    PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE') or 0) # Доля запросов, выполняемых под cProfile
+    RENDER_CACHE_BYTES = int(os.environ.get('RENDER_CACHE_BYTES') or 64 * 1024 * 1024) # Бюджет памяти кэша готовых документов
+    RENDER_CACHE_DIR = os.environ.get('RENDER_CACHE_DIR') # Дисковый уровень кэша, например ./Ready_doc/render_cache
+    JOB_WORKERS = int(os.environ.get('JOB_WORKERS') or 2) # Потоки, разбирающие очередь фонового рендеринга
+    JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL') or 1.0) # Как часто воркеры проверяют очередь, сек
+    JOB_STALE_AFTER = int(os.environ.get('JOB_STALE_AFTER') or 600) # Аренда задания, сек: дольше рендеринг прерывается, зависшее задание возвращается в очередь
+    RENDER_CONCURRENCY = int(os.environ.get('RENDER_CONCURRENCY') or RENDER_WORKERS) # Сколько рендерингов выполняется одновременно
+    RENDER_QUEUE_SIZE = int(os.environ.get('RENDER_QUEUE_SIZE') or RENDER_CONCURRENCY * 4) # Сколько запросов ждут слота, остальным сразу 503
+    RENDER_QUEUE_TIMEOUT = float(os.environ.get('RENDER_QUEUE_TIMEOUT') or 10) # Сколько секунд запрос ждет слота
+    RENDER_PER_USER = int(os.environ.get('RENDER_PER_USER') or 0) or None # Слотов на одного пользователя, по умолчанию половина
+    WARM_UP = os.environ.get('WARM_UP', '').lower() in ('1', 'true', 'yes') # Загружать шаблоны при создании приложения (до fork при gunicorn --preload)
+    SHARD_DIR = SHARD_DIR # Каталог файлов шардов партнеров; пусто - все в одной БД (см. Services/sharding.py)
     
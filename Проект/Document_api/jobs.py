@@ -0,0 +1,171 @@
+import datetime
+import io
+import json
+import threading
+import time
+import uuid
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from flask import current_app
+from sqlalchemy import select, update
+
+from . import db
+from .models import DocumentCounter, ReadyDoc, RenderJob
+from Services.report_service import record_document
+from Services.search_service import document_text, index_document
+from Services.upload_storage import BlobStore
+
+def submit_job(payload):
+    """Ставит рендеринг в очередь и сразу возвращает идентификатор задания."""
+    job = RenderJob(id=uuid.uuid4().hex, status="queued", payload=json.dumps(payload, ensure_ascii=False))
+    db.session.add(job)
+    db.session.commit()
+    job_workers.start(current_app._get_current_object())
+    job_workers.notify()
+    return job.id
+
+
+class JobWorkers:
+    """Локальный пул потоков, разбирающий очередь RenderJob.
+
+    Сам рендеринг уходит в общий пул процессов, поэтому потоки почти не
+    держат GIL и не мешают веб-запросам. Задания, поставленные другими
+    процессами, подхватываются опросом таблицы раз в poll_interval секунд.
+
+    Взятое задание арендовано на lease секунд (JOB_STALE_AFTER): рендеринг
+    дольше аренды прерывается, а задания с истекшей арендой (процесс упал)
+    опрос возвращает в очередь. Результат записывается, только если аренда
+    все еще своя, поэтому задание не может завершиться дважды.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.blob_store = None
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._next_requeue = 0.0
+
+    def start(self, app):
+        """Запускает потоки при первом задании; настройки берутся из конфигурации app."""
+        with self._lock:
+            if self._threads:
+                return
+            self.app = app
+            self.blob_store = BlobStore(app.config['UPLOAD_FOLDER'])
+            self.poll_interval = app.config['JOB_POLL_INTERVAL']
+            self.lease = app.config['JOB_STALE_AFTER']
+            for index in range(app.config['JOB_WORKERS']):
+                thread = threading.Thread(target=self._run, name=f"render-job-{index}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def notify(self):
+        self._wakeup.set()
+
+    def _requeue_stale(self):
+        # Задания, оставшиеся в running после падения процесса, возвращаем в очередь;
+        # из всех потоков процесса проверку делает не чаще раза в poll_interval один
+        with self._lock:
+            if time.monotonic() < self._next_requeue:
+                return
+            self._next_requeue = time.monotonic() + self.poll_interval
+        deadline = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.lease)
+        db.session.execute(
+            update(RenderJob)
+            .where(RenderJob.status == "running", RenderJob.started_at < deadline)
+            .values(status="queued", started_at=None)
+        )
+        db.session.commit()
+
+    def _run(self):
+        while True:
+            try:
+                with self.app.app_context():
+                    self._requeue_stale()
+                    claimed = self._claim()
+                    if claimed:
+                        self._process(*claimed)
+                        continue
+            except Exception:
+                self.app.logger.exception("Render job worker failed")
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+    def _claim(self):
+        """Атомарно переводит самое старое задание из queued в running; (id, payload, начало аренды)."""
+        oldest = (
+            select(RenderJob.id)
+            .where(RenderJob.status == "queued")
+            .order_by(RenderJob.created_at)
+            .limit(1)
+            .scalar_subquery()
+        )
+        started_at = datetime.datetime.utcnow()
+        row = db.session.execute(
+            update(RenderJob)
+            .where(RenderJob.id == oldest, RenderJob.status == "queued")
+            .values(status="running", started_at=started_at)
+            .returning(RenderJob.id, RenderJob.payload)
+        ).first()
+        db.session.commit()
+        return (row[0], json.loads(row[1]), started_at) if row else None
+
+    def _render(self, payload, started_at):
+        from Services.document_service import submit_render
+
+        # Сломанный чужим заданием пул уже заменен новым: повторяем один раз
+        for attempt in range(2):
+            remaining = self.lease - (datetime.datetime.utcnow() - started_at).total_seconds()
+            future = submit_render(payload["template_path"], payload["placeholders"], self.app.config['RENDER_WORKERS'])
+            try:
+                return future.result(timeout=max(remaining, 0))
+            except FutureTimeoutError:
+                future.cancel()
+                raise RuntimeError(f"Rendering took longer than {self.lease} s") from None
+            except BrokenProcessPool:
+                if attempt:
+                    raise
+
+    def _finish(self, job_id, started_at, **values):
+        # Аренда истекла и задание уже у другого воркера - результат не наш
+        finished = db.session.execute(
+            update(RenderJob)
+            .where(RenderJob.id == job_id, RenderJob.status == "running", RenderJob.started_at == started_at)
+            .values(finished_at=datetime.datetime.utcnow(), **values)
+        )
+        return finished.rowcount == 1
+
+    def _process(self, job_id, payload, started_at):
+        try:
+            document_bytes = self._render(payload, started_at)
+            content_hash, result_path, _ = self.blob_store.save(io.BytesIO(document_bytes), "docx")
+
+            # Номер, запись ReadyDoc и статус задания - одной транзакцией
+            date = datetime.datetime.strptime(payload["date"], '%Y-%m-%d').date()
+            new_document = ReadyDoc(
+                date=date,
+                sum=payload.get("sum"),
+                legalEntities=payload.get("legalEntities"),
+                signatories=payload.get("signatories"),
+                link=result_path,
+                content_hash=content_hash,
+                document_number=DocumentCounter.allocate(date)
+            )
+            db.session.add(new_document)
+            record_document(db.session, date, new_document.legalEntities, new_document.sum)
+            db.session.flush()
+            index_document(db.session, new_document.id, document_text(document_bytes))
+            if not self._finish(job_id, started_at, status="done", ready_doc_id=new_document.id, result_path=result_path):
+                db.session.rollback()
+                self.app.logger.warning("Render job %s lease expired, result discarded", job_id)
+                return
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            self._finish(job_id, started_at, status="failed", error=str(e))
+            db.session.commit()
+
+
+job_workers = JobWorkers()
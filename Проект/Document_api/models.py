@@ -1,10 +1,12 @@
 from . import db
-from sqlalchemy import Column, Integer, String, ForeignKey, Date, Numeric
+from sqlalchemy import Column, Integer, String, ForeignKey, Date, DateTime, Text, Index, func, select, update
+from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.orm import relationship
 from werkzeug.security import generate_password_hash, check_password_hash
 import datetime  # Import the datetime module
 from sqlalchemy.types import TypeDecorator, NUMERIC
 from decimal import Decimal
+from Services.sharding import catalog_transaction
 
 
 
@@ -24,10 +26,11 @@ class NumericDecimal(TypeDecorator):
             return Decimal(value)
         return value
 
-    class Settings(db.Model):
-        __tablename__ = "Settings"
-        id = Column(Integer, primary_key=True, index=True)
-        vat_rate = Column(NumericDecimal, default=Decimal('0.05'))  # Ставка НДС, по умолчанию 5%
+
+class Settings(db.Model):
+    __tablename__ = "Settings"
+    id = Column(Integer, primary_key=True, index=True)
+    vat_rate = Column(NumericDecimal, default=Decimal('0.05'))  # Ставка НДС, по умолчанию 5%
 
 class Doctype(db.Model):
     __tablename__ = "Doctype"
@@ -55,6 +58,81 @@ class ReadyDoc(db.Model):
     signatories = Column(String)
     link = Column(String)
     document_number = Column(Integer)  # Номер документа в месяце
+    content_hash = Column(String(64), index=True)  # SHA-256 файла, если он загружен
+
+    __table_args__ = (
+        Index("ix_ReadyDoc_date_document_number", "date", "document_number"),
+        Index("ix_ReadyDoc_legalEntities_date", "legalEntities", "date"),
+    )
+
+
+class DocumentCounter(db.Model):
+    """Последний выданный номер документа за каждый месяц."""
+    __tablename__ = "DocumentCounter"
+    year = Column(Integer, primary_key=True)
+    month = Column(Integer, primary_key=True)
+    last_number = Column(Integer, nullable=False, default=0)
+
+    @classmethod
+    def allocate(cls, date, count=1):
+        """Резервирует count номеров подряд за месяц даты date и возвращает первый из них.
+
+        Вызывается внутри транзакции вставки ReadyDoc: счетчик меняется одним
+        атомарным UPDATE, поэтому параллельные запросы не получат один номер.
+        Только первый номер месяца без счетчика заводит его UPSERT-ом,
+        продолжая нумерацию от уже выданных номеров. При шардировании номер
+        выдается отдельной короткой транзакцией каталога до записи в шард;
+        если запись документа потом откатится, номер пропадет.
+        """
+        transaction = catalog_transaction(db.session)
+        if transaction is None:
+            return cls._allocate(db.session, date, count)
+        with transaction as connection:
+            return cls._allocate(connection, date, count)
+
+    @classmethod
+    def _allocate(cls, executor, date, count):
+        statement = update(cls).where(cls.year == date.year, cls.month == date.month).values(
+            last_number=cls.last_number + count
+        ).returning(cls.last_number).execution_options(synchronize_session=False)
+        last_number = executor.execute(statement).scalar_one_or_none()
+        if last_number is None:
+            last_number = executor.execute(cls._seed_statement(date, count)).scalar_one()
+        return last_number - count + 1
+
+    @classmethod
+    def _seed_statement(cls, date, count):
+        # max по всему месяцу ReadyDoc считается один раз на месяц, а не на каждый номер
+        month_start = datetime.date(date.year, date.month, 1)
+        next_month = datetime.date(date.year + date.month // 12, date.month % 12 + 1, 1)
+        existing = select(func.coalesce(func.max(ReadyDoc.document_number), 0)).where(
+            ReadyDoc.date >= month_start, ReadyDoc.date < next_month
+        ).scalar_subquery()
+        # Параллельный запрос мог завести счетчик между UPDATE и INSERT: тогда просто прибавляем
+        return insert(cls).values(
+            year=date.year, month=date.month, last_number=existing + count
+        ).on_conflict_do_update(
+            index_elements=[cls.year, cls.month],
+            set_={"last_number": cls.last_number + count},
+        ).returning(cls.last_number)
+
+class RenderJob(db.Model):
+    """Задание на фоновый рендеринг документа; очередь живет прямо в SQLite."""
+    __tablename__ = "RenderJob"
+    id = Column(String(32), primary_key=True)
+    status = Column(String, nullable=False, default="queued")  # queued, running, done, failed
+    payload = Column(Text, nullable=False)  # JSON тела запроса /process_document
+    error = Column(Text)
+    ready_doc_id = Column(Integer, ForeignKey("ReadyDoc.id"))
+    result_path = Column(String)
+    created_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+
+    __table_args__ = (
+        Index("ix_RenderJob_status_created_at", "status", "created_at"),
+    )
+
 
 class DocTemp(db.Model):
     __tablename__ = "DocTemp"
@@ -62,6 +140,8 @@ class DocTemp(db.Model):
     compName = Column(String, ForeignKey("LegalEntities.name"))
     docType = Column(String, ForeignKey("Doctype.type"))
     link = Column(String)
+    content_hash = Column(String(64), index=True)  # SHA-256 загруженного файла
+    placeholder_manifest = Column(Text)  # JSON, см. Services/template_manifest.py
 
     legal_entity = relationship("LegalEntities", backref="templates")
     doctype = relationship("Doctype", backref="templates")
@@ -83,4 +163,4 @@ class Users(db.Model):
         self.password_hash = generate_password_hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, self.password)
+        return check_password_hash(self.password_hash, password)
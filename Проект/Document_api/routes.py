@@ -1,19 +1,97 @@
 
 # document_api/routes.py
-from flask import request, jsonify, send_file
-from . import app, db
-from .models import Users, Doctype, LegalEntities, DocTemp, ReadyDoc, Employees, Settings
-from .utils import token_required
-from .services.document_service import process_document
-from werkzeug.utils import secure_filename
+from flask import Blueprint, current_app, request, jsonify, send_file, Response, stream_with_context
+from . import db
+from .models import Users, Doctype, LegalEntities, DocTemp, ReadyDoc, Employees, Settings, DocumentCounter, RenderJob
+from .config import Config
+from .utils import batch_render_limited, render_limited, token_required, ZipStream
+from .jobs import submit_job
+from Services.auth_service import issue_token
+from Services.lookup_cache import LookupCache, MISSING
+from Services.calendar_service import MAX_YEAR, MIN_YEAR, production_calendar
+from Services.payroll_service import HOURS_PER_DAY, calculate_payroll, json_amounts, to_decimal
+from Services.report_service import query_summary, record_document, record_documents
+from Services.search_service import document_text, index_document, search_documents
+from Services.template_manifest import build_manifest, dump_manifest, load_manifest, validate_placeholders
+from Services.export_service import EXPORT_FORMATS, fetch_page, iter_csv, iter_ndjson, iter_sorted_rows
+from Services.sharding import statement_engines
+from Services.import_service import detect_format, import_records, iter_records
+from Services.render_cache import DOCX_MIMETYPE
+from sqlalchemy import func, select
+from decimal import Decimal
 import os
+import io
 import datetime
-from workalendar.europe import Russia
-import calendar #Импорт calendar для определения кол-ва дней в месяце
+import json
+import zipfile
 
 TEMPLATE_FOLDER = os.path.join(Config.APP_ROOT, '../Templates') # Используем Путь к папке с шаблонами
+WORKING_DAYS_BULK_LIMIT = 1200 # Месяцев в одном запросе /working_days_bulk
 
-@app.route("/get_template", methods=["POST"])
+# python-docx тяжелый: document_service импортируется в маршрутах рендеринга при первом вызове
+bp = Blueprint('document_api', __name__)
+
+@bp.route('/login', methods=['POST'])
+def login():
+    auth = request.authorization
+    if not auth or not auth.username or not auth.password:
+        return jsonify({'message': 'Authentication required'}), 401
+
+    user = Users.query.filter_by(username=auth.username).first()
+    if not user or not user.check_password(auth.password):
+        return jsonify({'message': 'Invalid credentials'}), 401
+
+    token = issue_token(user.username, current_app.config['SECRET_KEY'])
+    return jsonify({'message': 'Login successful', 'token': token, 'token_type': 'Bearer'})
+
+DOCUMENT_TYPE_MAPPING = {
+    "заявка": "Заказ",
+    "заказ": "Заказ",
+    "акт": "Акт",
+    "отчёт": "Отчет"
+}
+
+# (компания, тип документа) -> ответ с путем и манифестом шаблона или None, если для промаха
+# компания и тип документа уже заведены; сам промах по кэшу не отдается
+template_cache = LookupCache()
+# SHA-256 шаблона -> манифест или None, если шаблон загружен без него
+manifest_cache = LookupCache()
+
+
+def template_manifest(template):
+    """Манифест DocTemp; для шаблонов, загруженных до появления манифестов, строится и сохраняется здесь."""
+    if template.placeholder_manifest:
+        return load_manifest(template.placeholder_manifest)
+    if not template.link or not template.link.endswith('.docx') or not os.path.isfile(template.link):
+        return None
+
+    from Services.document_service import template_content_hash
+
+    manifest = build_manifest(template.link)
+    template.placeholder_manifest = dump_manifest(manifest)
+    template.content_hash = template.content_hash or template_content_hash(template.link)
+    db.session.commit()
+    return manifest
+
+
+def manifest_for_path(template_path):
+    """Манифест шаблона по содержимому файла: клиент присылает путь, а не id DocTemp."""
+    from Services.document_service import template_content_hash
+
+    content_hash = template_content_hash(template_path)
+    manifest = manifest_cache.get(content_hash)
+    if manifest is MISSING:
+        stored = db.session.scalar(
+            select(DocTemp.placeholder_manifest)
+            .where(DocTemp.content_hash == content_hash, DocTemp.placeholder_manifest.is_not(None))
+            .limit(1)
+        )
+        manifest = load_manifest(stored)
+        manifest_cache.set(content_hash, manifest)
+    return manifest
+
+
+@bp.route("/get_template", methods=["POST"])
 @token_required
 def get_template():
     data = request.get_json()
@@ -21,43 +99,47 @@ def get_template():
     user_input_company = data.get("company_name", "").strip()
     user_input_director = data.get("director_name", "").strip()
 
-    document_type_mapping = {
-        "заявка": "Заказ",
-        "заказ": "Заказ",
-        "акт": "Акт",
-        "отчёт": "Отчет"
-    }
-    document_type = document_type_mapping.get(user_input_type, user_input_type.capitalize())
+    document_type = DOCUMENT_TYPE_MAPPING.get(user_input_type, user_input_type.capitalize())
+    cache_key = (user_input_company, document_type)
 
-    template = DocTemp.query.join(Doctype).join(LegalEntities).filter(
-        LegalEntities.name == user_input_company,
-        Doctype.type == document_type
+    cached = template_cache.get(cache_key)
+    if cached is not MISSING and cached is not None:
+        return jsonify(cached)
+
+    # Промах каждый раз проверяем по БД: шаблон заводит /create_template другого
+    # процесса, и появиться он должен сразу, а не по истечении TTL
+    template = DocTemp.query.filter(
+        DocTemp.compName == user_input_company,
+        DocTemp.docType == document_type
     ).first()
 
     if template:
         template_path = os.path.join(TEMPLATE_FOLDER, os.path.basename(template.link)) #Получаем путь к шаблону
-        return jsonify({"template_path": template_path})  # Отправляем путь к шаблону на фронтенд
-    else:
-        company = LegalEntities.query.filter(LegalEntities.name == user_input_company).first()
-        if not company:
-            new_company = LegalEntities(name=user_input_company, director=user_input_director)
-            db.session.add(new_company)
-            db.session.commit()
-        else:
-            if "director_name" in data and data["director_name"]:
-                company.director = data["director_name"]
-                db.session.commit()
-
-        doctype = Doctype.query.filter(Doctype.type == document_type).first()
-        if not doctype:
-            new_doctype = Doctype(type=document_type)
-            db.session.add(new_doctype)
-            db.session.commit()
+        result = {"template_path": template_path, "manifest": template_manifest(template)}
+        template_cache.set(cache_key, result)
+        return jsonify(result)  # Отправляем путь к шаблону и манифест на фронтенд
 
+    # None в кэше: компания и тип документа уже заведены, без нового директора писать нечего
+    if cached is None and not user_input_director:
         return jsonify({"message": "Шаблон не найден. Необходимо создать шаблон вручную."})
 
-@app.route('/process_document', methods=['POST'])
+    # Компанию и тип документа заводим одной транзакцией
+    company = db.session.get(LegalEntities, user_input_company)
+    if not company:
+        db.session.add(LegalEntities(name=user_input_company, director=user_input_director))
+    elif user_input_director:
+        company.director = user_input_director
+
+    if not db.session.get(Doctype, document_type):
+        db.session.add(Doctype(type=document_type))
+    db.session.commit()
+    template_cache.set(cache_key, None)
+
+    return jsonify({"message": "Шаблон не найден. Необходимо создать шаблон вручную."})
+
+@bp.route('/process_document', methods=['POST'])
 @token_required
+@render_limited
 def process_document_route():
     data = request.get_json()
     template_path = data.get("template_path")  # Получаем путь с фронтенда
@@ -71,17 +153,25 @@ def process_document_route():
     if not template_path or not placeholders:
         return jsonify({'error': 'Missing template_path or placeholders'}), 400
 
+    # Старые клиенты получают base64 в JSON, новые могут попросить сам файл
+    send_binary = data.get("response_mode") == "file" or \
+        request.accept_mimetypes.best_match([DOCX_MIMETYPE, 'application/json']) == DOCX_MIMETYPE
+
     try:
-        processed_document = process_document(template_path, placeholders)
+        from Services.document_service import encode_document, render_document
 
-        # Получаем последний номер документа за текущий месяц
-        last_doc = ReadyDoc.query.filter(db.extract('year', ReadyDoc.date) == date.year,
-                                        db.extract('month', ReadyDoc.date) == date.month).order_by(ReadyDoc.document_number.desc()).first()
+        # Проверяем поля по манифесту до рендеринга; без манифеста рендерим как раньше
+        parts = None
+        manifest = manifest_for_path(template_path)
+        if manifest is not None:
+            errors, parts = validate_placeholders(manifest, placeholders)
+            if errors:
+                return jsonify(dict(errors, error='Placeholders do not match template')), 400
 
-        if last_doc:
-            next_document_number = last_doc.document_number + 1
-        else:
-            next_document_number = 1
+        document_bytes = render_document(template_path, placeholders, parts)
+
+        # Номер документа в месяце выдается счетчиком в той же транзакции, что и вставка
+        next_document_number = DocumentCounter.allocate(date)
 
         # Создаем новую запись о документе
         new_document = ReadyDoc(
@@ -93,52 +183,434 @@ def process_document_route():
             document_number=next_document_number
         )
         db.session.add(new_document)
+        record_document(db.session, date, legalEntities, sum)
+        db.session.flush()
+        index_document(db.session, new_document.id, document_text(document_bytes))
         db.session.commit()
 
-        return jsonify({'document': processed_document})  # Возвращаем base64 encoded строку
+        if send_binary:
+            download_name = f"{next_document_number}_{os.path.basename(template_path)}"
+            return send_file(io.BytesIO(document_bytes), mimetype=DOCX_MIMETYPE,
+                             as_attachment=True, download_name=download_name)
+
+        return jsonify({'document': encode_document(document_bytes)})  # Возвращаем base64 encoded строку
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/calculate_salary', methods=['POST'])
+@bp.route('/jobs/process_document', methods=['POST'])
+@token_required
+def submit_document_job():
+    """Ставит рендеринг в очередь и сразу отвечает 202 с идентификатором задания."""
+    data = request.get_json(silent=True) or {}
+    if not data.get("template_path") or not data.get("placeholders"):
+        return jsonify({'error': 'Missing template_path or placeholders'}), 400
+    try:
+        datetime.datetime.strptime(data.get("date") or "", '%Y-%m-%d')
+    except ValueError:
+        return jsonify({'error': 'Invalid date, expected YYYY-MM-DD'}), 400
+
+    payload = {key: data.get(key) for key in ("template_path", "placeholders", "sum", "legalEntities", "signatories", "date")}
+    job_id = submit_job(payload)
+    return jsonify({'job_id': job_id, 'status': 'queued', 'status_url': f'/jobs/{job_id}'}), 202
+
+@bp.route('/jobs/<job_id>', methods=['GET'])
+@token_required
+def get_document_job(job_id):
+    job = db.session.get(RenderJob, job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+
+    result = {'job_id': job.id, 'status': job.status, 'created_at': job.created_at.isoformat()}
+    if job.status == "done":
+        result['ready_doc_id'] = job.ready_doc_id
+        result['result_url'] = f'/jobs/{job.id}/result'
+    elif job.status == "failed":
+        result['error'] = job.error
+    return jsonify(result)
+
+@bp.route('/jobs/<job_id>/result', methods=['GET'])
+@token_required
+def get_document_job_result(job_id):
+    job = db.session.get(RenderJob, job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    if job.status != "done":
+        return jsonify({'error': f'Job is {job.status}', 'status': job.status}), 409
+
+    return send_file(os.path.abspath(job.result_path), mimetype=DOCX_MIMETYPE,
+                     as_attachment=True, download_name=f"{job.id}.docx")
+
+@bp.route('/process_documents_batch', methods=['POST'])
+@token_required
+@batch_render_limited
+def process_documents_batch():
+    data = request.get_json()
+    items = data.get("items") if data else None
+
+    if not items or not isinstance(items, list):
+        return jsonify({'error': 'Missing items'}), 400
+    if len(items) > current_app.config['BATCH_MAX_ITEMS']:
+        return jsonify({'error': 'Too many items'}), 400
+
+    # Проверяем весь пакет до начала рендеринга: после отправки первых байт архива код ответа уже не поменять
+    jobs = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            return jsonify({'error': f'Item {index} must be an object'}), 400
+        template_path = item.get("template_path")
+        placeholders = item.get("placeholders")
+        if not template_path or not placeholders:
+            return jsonify({'error': f'Missing template_path or placeholders in item {index}'}), 400
+        if not os.path.isfile(template_path):
+            return jsonify({'error': f'Template not found in item {index}'}), 400
+        try:
+            item["date"] = datetime.datetime.strptime(item.get("date"), '%Y-%m-%d').date()
+        except (TypeError, ValueError):
+            return jsonify({'error': f'Invalid date in item {index}'}), 400
+        jobs.append((template_path, placeholders))
+
+    def generate():
+        from Services.document_service import render_many
+
+        stream = ZipStream()
+        errors = []
+        rendered = []
+        texts = {}
+        with zipfile.ZipFile(stream, 'w', zipfile.ZIP_STORED) as archive:
+            # .docx уже сжат, поэтому складываем в архив без повторной компрессии
+            for index, result in render_many(jobs, current_app.config['RENDER_WORKERS']):
+                if isinstance(result, Exception):
+                    errors.append({'item': index, 'error': str(result)})
+                    continue
+                name = f"{index + 1:04d}_{os.path.basename(jobs[index][0])}"
+                archive.writestr(name, result)
+                texts[index] = document_text(result)
+                rendered.append(index)
+                yield stream.drain()
+
+            # Записи о документах добавляем одной транзакцией, только для успешно созданных;
+            # номера резервируем блоком на каждый месяц
+            rendered.sort()
+            month_counts = {}
+            for index in rendered:
+                date = items[index]["date"]
+                month = (date.year, date.month)
+                month_counts[month] = month_counts.get(month, 0) + 1
+            try:
+                next_numbers = {
+                    month: DocumentCounter.allocate(datetime.date(month[0], month[1], 1), count)
+                    for month, count in month_counts.items()
+                }
+                for index in rendered:
+                    item = items[index]
+                    date = item["date"]
+                    month = (date.year, date.month)
+                    item["ready_doc"] = ReadyDoc(
+                        date=date,
+                        sum=item.get("sum"),
+                        legalEntities=item.get("legalEntities"),
+                        signatories=item.get("signatories"),
+                        link=item["template_path"],
+                        document_number=next_numbers[month]
+                    )
+                    db.session.add(item["ready_doc"])
+                    next_numbers[month] += 1
+                record_documents(db.session, [
+                    (items[index]["date"], items[index].get("legalEntities"), items[index].get("sum"))
+                    for index in rendered
+                ])
+                db.session.flush()
+                for index in rendered:
+                    index_document(db.session, items[index]["ready_doc"].id, texts[index])
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                errors.append({'item': None, 'error': str(e)})
+
+            if errors:
+                archive.writestr('errors.json', json.dumps(errors, ensure_ascii=False))
+        yield stream.drain()
+
+    return Response(stream_with_context(generate()), mimetype='application/zip',
+                    headers={'Content-Disposition': 'attachment; filename=documents.zip'})
+
+REPORT_GROUPINGS = ('entity', 'month', 'entity_month')
+
+def parse_report_month(value):
+    """'YYYY-MM' -> (год, месяц)."""
+    date = datetime.datetime.strptime(value, '%Y-%m')
+    return date.year, date.month
+
+@bp.route('/reports/ready_docs', methods=['GET'])
+@token_required
+def ready_docs_report():
+    """Количество и сумма готовых документов по юрлицу и/или месяцу из сводной таблицы."""
+    group_by = request.args.get("group_by", "entity_month")
+    if group_by not in REPORT_GROUPINGS:
+        return jsonify({'error': f'group_by must be one of {", ".join(REPORT_GROUPINGS)}'}), 400
+    try:
+        date_from = parse_report_month(request.args["from"]) if request.args.get("from") else None
+        date_to = parse_report_month(request.args["to"]) if request.args.get("to") else None
+    except ValueError:
+        return jsonify({'error': 'Invalid period, expected YYYY-MM'}), 400
+
+    rows = query_summary(db.session, group_by, request.args.get("legal_entity"), date_from, date_to)
+    return jsonify({'group_by': group_by, 'rows': rows})
+
+@bp.route('/search', methods=['GET'])
+@token_required
+def search_ready_docs():
+    """Полнотекстовый поиск по готовым документам: ?q=...&limit=20&offset=0."""
+    query = request.args.get("q", "").strip()
+    if not query:
+        return jsonify({'error': 'Missing q'}), 400
+    try:
+        limit = int(request.args.get("limit", 20))
+        offset = int(request.args.get("offset", 0))
+    except ValueError:
+        return jsonify({'error': 'Invalid limit or offset'}), 400
+
+    results, has_more = search_documents(db.session, query, limit, offset)
+    for result in results:
+        if isinstance(result['date'], datetime.date):
+            result['date'] = result['date'].isoformat()
+    response = {'results': results}
+    if has_more:
+        response['next_offset'] = offset + len(results)
+    return jsonify(response)
+
+READY_DOC_COLUMNS = (
+    ReadyDoc.id, ReadyDoc.date, ReadyDoc.sum, ReadyDoc.legalEntities, ReadyDoc.signatories,
+    ReadyDoc.link, ReadyDoc.document_number, ReadyDoc.content_hash,
+)
+TEMPLATE_COLUMNS = (DocTemp.id, DocTemp.compName, DocTemp.docType, DocTemp.link, DocTemp.content_hash)
+
+def ready_docs_query(args):
+    """Выборка ReadyDoc и ключ сортировки по параметрам legal_entity, date_from, date_to, order=id|date."""
+    statement = select(*READY_DOC_COLUMNS)
+    if args.get("legal_entity"):
+        statement = statement.where(ReadyDoc.legalEntities == args["legal_entity"])
+    if args.get("date_from"):
+        statement = statement.where(ReadyDoc.date >= datetime.datetime.strptime(args["date_from"], '%Y-%m-%d').date())
+    if args.get("date_to"):
+        statement = statement.where(ReadyDoc.date <= datetime.datetime.strptime(args["date_to"], '%Y-%m-%d').date())
+
+    order = args.get("order", "id")
+    if order == "date":
+        # У старых документов номера нет: считаем его нулем, id делает ключ уникальным
+        return statement, [ReadyDoc.date, func.coalesce(ReadyDoc.document_number, 0), ReadyDoc.id]
+    if order == "id":
+        return statement, [ReadyDoc.id]
+    raise ValueError('order must be id or date')
+
+def templates_query(args):
+    """Выборка DocTemp по параметрам legal_entity и doc_type, ключ - id."""
+    statement = select(*TEMPLATE_COLUMNS)
+    if args.get("legal_entity"):
+        statement = statement.where(DocTemp.compName == args["legal_entity"])
+    if args.get("doc_type"):
+        statement = statement.where(DocTemp.docType == args["doc_type"])
+    return statement, [DocTemp.id]
+
+def list_page(build_query):
+    try:
+        statement, key_columns = build_query(request.args)
+        limit = int(request.args.get("limit", 100))
+        items, next_cursor = fetch_page(db.session, statement, key_columns, request.args.get("cursor"), limit)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'items': items, 'next_cursor': next_cursor})
+
+def export_stream(build_query, columns, name):
+    """Выгрузка всей выборки в NDJSON (по умолчанию) или CSV без загрузки в память."""
+    export_format = request.args.get("format", "ndjson")
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'error': 'format must be ndjson or csv'}), 400
+    try:
+        statement, key_columns = build_query(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    rows = iter_sorted_rows(statement_engines(db.session, statement), statement, key_columns)
+    if export_format == "csv":
+        chunks = iter_csv(rows, [column.key for column in columns])
+    else:
+        chunks = iter_ndjson(rows)
+    return Response(stream_with_context(chunks), mimetype=EXPORT_FORMATS[export_format],
+                    headers={'Content-Disposition': f'attachment; filename={name}.{export_format}'})
+
+@bp.route('/ready_docs', methods=['GET'])
+@token_required
+def list_ready_docs():
+    """Готовые документы страницами: ?legal_entity=&date_from=&date_to=&order=id|date&limit=&cursor=."""
+    return list_page(ready_docs_query)
+
+@bp.route('/ready_docs/export', methods=['GET'])
+@token_required
+def export_ready_docs():
+    return export_stream(ready_docs_query, READY_DOC_COLUMNS, 'ready_docs')
+
+@bp.route('/templates', methods=['GET'])
+@token_required
+def list_templates():
+    """Шаблоны страницами: ?legal_entity=&doc_type=&limit=&cursor=."""
+    return list_page(templates_query)
+
+@bp.route('/templates/export', methods=['GET'])
+@token_required
+def export_templates():
+    return export_stream(templates_query, TEMPLATE_COLUMNS, 'templates')
+
+def import_stream(kind):
+    """Справочник из тела запроса или файла формы (поле file).
+
+    Формат - ?format=, иначе Content-Type тела или файла, иначе расширение файла.
+    """
+    upload = request.files.get('file')
+    if upload is not None:
+        import_format = request.args.get("format") or detect_format(upload.mimetype, upload.filename)
+        stream = upload.stream
+    else:
+        import_format = request.args.get("format") or detect_format(request.mimetype)
+        stream = request.stream
+    if import_format not in ('csv', 'ndjson'):
+        return jsonify({'error': 'format must be csv or ndjson'}), 400
+
+    report = import_records(db.session, kind, iter_records(stream, import_format))
+    return jsonify(report), 400 if 'error' in report else 200
+
+@bp.route('/employees/import', methods=['POST'])
+@token_required
+def import_employees():
+    """Сотрудники со ставкой: CSV с колонками employee,rate или NDJSON {"employee", "rate"}."""
+    return import_stream('employees')
+
+@bp.route('/legal_entities/import', methods=['POST'])
+@token_required
+def import_legal_entities():
+    """Юрлица: CSV с колонками name,director или NDJSON {"name", "director"}."""
+    return import_stream('legal_entities')
+
+@bp.route('/doctypes/import', methods=['POST'])
+@token_required
+def import_doctypes():
+    """Типы документов: CSV с колонкой type или NDJSON {"type"}."""
+    return import_stream('doctypes')
+
+@bp.route('/admission_stats', methods=['GET'])
+@token_required
+def admission_stats():
+    """Состояние лимитера рендеринга для настройки RENDER_CONCURRENCY и очереди."""
+    return jsonify(current_app.extensions['render_limiter'].stats())
+
+def load_rates(employee_names=None):
+    """Ставки сотрудников и ставка НДС одним запросом: {имя: ставка}, НДС."""
+    vat_rate = select(Settings.vat_rate).order_by(Settings.id).limit(1).scalar_subquery()
+    query = select(Employees.employee, Employees.rate, vat_rate)
+    if employee_names is not None:
+        query = query.where(Employees.employee.in_(employee_names))
+    rows = db.session.execute(query).all()
+    return {row[0]: row[1] for row in rows}, (rows[0][2] if rows else None)
+
+
+@bp.route('/calculate_salary', methods=['POST'])
 @token_required
 def calculate_salary():
     data = request.get_json()
     employee_name = data.get('employee')
     hours_worked = data.get('hours')
 
-    employee = Employees.query.filter_by(employee=employee_name).first()
-    if not employee:
+    rates, vat_rate = load_rates([employee_name])
+    if employee_name not in rates:
         return jsonify({'error': 'Employee not found'}), 400
 
     try:
-        hours_worked = float(hours_worked)  # Преобразуем часы в число с плавающей точкой
+        hours_worked = to_decimal(hours_worked)  # Часы считаем в Decimal, как и ставку НДС
     except ValueError:
         return jsonify({'error': 'Invalid hours format'}), 400
 
-    salary_before_vat = employee.rate * hours_worked
+    salary = calculate_payroll([employee_name], [rates[employee_name]], [hours_worked], vat_rate)[0]
+    del salary['hours']
+    return jsonify(json_amounts(salary))
 
-    # Получаем ставку НДС из настроек
-    settings = Settings.query.first()
-    if settings:
-        vat_rate = settings.vat_rate
+@bp.route('/calculate_salaries', methods=['POST'])
+@token_required
+def calculate_salaries():
+    data = request.get_json()
+    items = data.get('items')
+    errors = []
+
+    if items:
+        # Явный список пар (сотрудник, часы)
+        if not isinstance(items, list):
+            return jsonify({'error': 'Items must be a list'}), 400
+        rates, vat_rate = load_rates({item.get('employee') for item in items if isinstance(item, dict)})
+        employees, hours = [], []
+        for index, item in enumerate(items):
+            name = item.get('employee') if isinstance(item, dict) else None
+            if name not in rates:
+                errors.append({'item': index, 'employee': name, 'error': 'Employee not found'})
+                continue
+            try:
+                hours.append(to_decimal(item.get('hours')))
+            except ValueError:
+                errors.append({'item': index, 'employee': name, 'error': 'Invalid hours format'})
+                continue
+            employees.append(name)
+    elif data.get('year') and data.get('month'):
+        # Период: всем (или перечисленным) сотрудникам норма часов по производственному календарю
+        try:
+            norm_hours = production_calendar.month_count(int(data['year']), int(data['month'])) * HOURS_PER_DAY
+        except (TypeError, ValueError):
+            return jsonify({'error': 'Invalid year or month format'}), 400
+        names = data.get('employees')
+        rates, vat_rate = load_rates(names)
+        employees = sorted(rates) if names is None else [name for name in names if name in rates]
+        errors = [{'employee': name, 'error': 'Employee not found'} for name in names or [] if name not in rates]
+        hours = [norm_hours] * len(employees)
     else:
-        vat_rate = 0.05  # Используем значение по умолчанию, если настроек нет
+        return jsonify({'error': 'Items or year and month are required'}), 400
+
+    salaries = calculate_payroll(employees, [rates[name] for name in employees], hours, vat_rate)
+    # Итоги складываем в Decimal, в float переводим только на выходе
+    return jsonify(json_amounts({
+        'salaries': [json_amounts(salary) for salary in salaries],
+        'errors': errors,
+        'total_before_vat': sum((salary['salary_before_vat'] for salary in salaries), Decimal('0.00')),
+        'total_vat': sum((salary['vat_amount'] for salary in salaries), Decimal('0.00')),
+        'total_with_vat': sum((salary['salary_with_vat'] for salary in salaries), Decimal('0.00'))
+    }))
 
-    vat_amount = salary_before_vat * vat_rate
-    salary_with_vat = salary_before_vat + vat_amount
+def working_days_payload(year, month):
+    bounds = production_calendar.month_bounds(year, month)
+    if bounds is None:
+        return None
+    return {
+        'start_date': bounds[0].strftime('%Y-%m-%d'), #Форматируем дату
+        'end_date': bounds[1].strftime('%Y-%m-%d'),
+        'working_days': production_calendar.month_count(year, month)
+    }
 
-    return jsonify({
-        'employee': employee_name,
-        'salary_before_vat': salary_before_vat,
-        'vat_rate': vat_rate,
-        'vat_amount': vat_amount,
-        'salary_with_vat': salary_with_vat
-    })
 
-@app.route('/working_days', methods=['POST'])
+@bp.route('/working_days', methods=['POST'])
 @token_required
 def get_working_days():
     data = request.get_json()
+
+    # Произвольный диапазон дат: только количество рабочих дней
+    if data.get('start_date') and data.get('end_date'):
+        try:
+            start = datetime.datetime.strptime(data['start_date'], '%Y-%m-%d').date()
+            end = datetime.datetime.strptime(data['end_date'], '%Y-%m-%d').date()
+        except (TypeError, ValueError):
+            return jsonify({'error': 'Invalid date format'}), 400
+        if not (MIN_YEAR <= start.year <= MAX_YEAR and MIN_YEAR <= end.year <= MAX_YEAR):
+            return jsonify({'error': f'Dates must be within years {MIN_YEAR}..{MAX_YEAR}'}), 400
+        if end.year - start.year > 50:
+            return jsonify({'error': 'Date range is too long'}), 400
+        return jsonify({'start_date': data['start_date'], 'end_date': data['end_date'],
+                        'working_days': production_calendar.count(start, end)})
+
     year = data.get('year')
     month = data.get('month')
 
@@ -148,24 +620,49 @@ def get_working_days():
     try:
         year = int(year)
         month = int(month)
+        payload = working_days_payload(year, month)
     except ValueError:
         return jsonify({'error': 'Invalid year or month format'}), 400
 
-    cal = Russia()
-    month_dates = [datetime.date(year, month, day) for day in range(1, calendar.monthrange(year, month)[1])] #Генерируем все даты месяца
-    working_days = [day for day in month_dates if cal.is_working_day(day)]
-
-    if working_days:
-        start_date = working_days[0].strftime('%Y-%m-%d') #Форматируем дату
-        end_date = working_days[-1].strftime('%Y-%m-%d')
-        return jsonify({'start_date': start_date, 'end_date': end_date})
+    if payload:
+        return jsonify(payload)
     else:
         return jsonify({'message': 'No working days in the specified month'}), 404
-with app.app_context():  # Создаем контекст приложения Flask
-    if not Settings.query.first():  # Проверяем, есть ли уже настройки
-        default_settings = Settings(vat_rate=0.05)  # Создаем настройки по умолчанию
-        db.session.add(default_settings)
-        db.session.commit()
 
-with app.app_context():
-    db.create_all()
\ No newline at end of file
+@bp.route('/working_days_bulk', methods=['POST'])
+@token_required
+def get_working_days_bulk():
+    data = request.get_json()
+    months = data.get('months')
+
+    # Вместо списка можно передать период: {"from": "2025-01", "to": "2025-12"}
+    if not months and data.get('from') and data.get('to'):
+        try:
+            from_year, from_month = (int(part) for part in data['from'].split('-'))
+            to_year, to_month = (int(part) for part in data['to'].split('-'))
+        except (AttributeError, ValueError):
+            return jsonify({'error': 'Invalid period format'}), 400
+        # Размер периода проверяем до того, как строить список месяцев
+        if to_year * 12 + to_month - (from_year * 12 + from_month) >= WORKING_DAYS_BULK_LIMIT:
+            return jsonify({'error': 'Too many months'}), 400
+        months = [
+            {'year': index // 12, 'month': index % 12 + 1}
+            for index in range(from_year * 12 + from_month - 1, to_year * 12 + to_month)
+        ]
+
+    if not months or not isinstance(months, list):
+        return jsonify({'error': 'Months or period are required'}), 400
+    if len(months) > WORKING_DAYS_BULK_LIMIT:
+        return jsonify({'error': 'Too many months'}), 400
+
+    results = []
+    for item in months:
+        try:
+            year = int(item.get('year'))
+            month = int(item.get('month'))
+            payload = working_days_payload(year, month)
+        except (AttributeError, TypeError, ValueError):
+            return jsonify({'error': 'Invalid year or month format'}), 400
+        results.append(dict(payload or {'working_days': 0}, year=year, month=month))
+
+    return jsonify({'months': results})
@@ -1,19 +1,84 @@
-from flask import request, jsonify
+from flask import g, request, jsonify, current_app
 from functools import wraps
 from .models import Users
-from . import db
+from Services.auth_service import CredentialCache, bearer_token, verify_token
+from Services.admission import limit_concurrency
+
+_credential_cache = None
+
+
+def get_credential_cache():
+    global _credential_cache
+    if _credential_cache is None:
+        _credential_cache = CredentialCache(current_app.config['SECRET_KEY'])
+    return _credential_cache
+
 
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
+        # Подписанный токен из /login проверяется без обращения к БД
+        token = bearer_token(request)
+        if token:
+            g.username = verify_token(token, current_app.config['SECRET_KEY'])
+            if not g.username:
+                return jsonify({'message': 'Invalid or expired token'}), 401
+            return f(*args, **kwargs)
+
         auth = request.authorization
         if not auth or not auth.username or not auth.password:
             return jsonify({'message': 'Authentication required'}), 401
 
+        # Запрос пользователя дешевый, дорого хэширование пароля: его и пропускает кэш
+        cache = get_credential_cache()
         user = Users.query.filter_by(username=auth.username).first()
-        if not user or not user.check_password(auth.password):
+        if not user:
             return jsonify({'message': 'Invalid credentials'}), 401
+        if not cache.check(auth.username, auth.password, user.password_hash):
+            if not user.check_password(auth.password):
+                return jsonify({'message': 'Invalid credentials'}), 401
+            cache.add(auth.username, auth.password, user.password_hash)
 
+        g.username = auth.username
         return f(*args, **kwargs)
 
     return decorated
+
+
+def current_user():
+    """Пользователь, прошедший token_required, или адрес клиента."""
+    return g.get('username') or request.remote_addr
+
+
+def batch_weight():
+    """Пакет рендерится сразу во все процессы пула: столько слотов он и занимает."""
+    data = request.get_json(silent=True)
+    items = data.get('items') if isinstance(data, dict) else None
+    return min(len(items) if isinstance(items, list) else 1, current_app.config['RENDER_WORKERS'])
+
+
+# Маршрут рендеринга под лимитером приложения; ставится после token_required
+render_limited = limit_concurrency(lambda: current_app.extensions['render_limiter'], current_user)
+batch_render_limited = limit_concurrency(lambda: current_app.extensions['render_limiter'], current_user, batch_weight)
+
+class ZipStream:
+    """Файлоподобный буфер для zipfile, который можно опустошать по частям.
+
+    zipfile умеет писать в поток без seek, поэтому архив отдается клиенту
+    по мере добавления файлов и целиком в памяти не держится.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
@@ -0,0 +1,230 @@
+"""Ограничение одновременных тяжелых запросов (рендеринг, загрузки) с очередью.
+
+Лимитер пропускает не больше max_concurrent запросов, остальных держит в
+ограниченной очереди не дольше max_wait секунд. Переполненная очередь и
+истекшее ожидание дают быстрый 503, превышение доли одного пользователя -
+429; оба ответа с Retry-After. Освободившийся слот достается тому, у кого
+сейчас меньше всего запросов в работе, поэтому пакетный клиент не вытесняет
+остальных. Дешевые маршруты лимитер не трогает вовсе.
+
+Очередь держит поток сервера, пока запрос ждет слота, поэтому она
+включается только на многопоточных серверах (wsgi.multithread). Под
+синхронными и pre-fork воркерами ожидающий запрос занял бы воркер целиком и
+не дал бы обслужить дешевые маршруты: там при занятых слотах сразу 503.
+"""
+from collections import defaultdict
+import functools
+import itertools
+import math
+import threading
+import time
+
+from Services.metrics import metrics
+
+SERVICE_TIME_SMOOTHING = 0.2  # Вес нового замера в скользящем среднем времени обработки
+
+metrics.counter('admission_requests_total', 'Admission decisions by limiter and result.')
+metrics.histogram('admission_wait_seconds', 'Time spent waiting for an admission slot.')
+
+
+class Rejected(Exception):
+    def __init__(self, status, reason, retry_after):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    __slots__ = ('user', 'seq', 'slots', 'event', 'granted')
+
+    def __init__(self, user, seq, slots):
+        self.user = user
+        self.seq = seq
+        self.slots = slots
+        self.event = threading.Event()
+        self.granted = False
+
+
+class AdmissionLimiter:
+    def __init__(self, name, max_concurrent, max_queue, max_wait, per_user=None, per_user_queue=None):
+        self.name = name
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queue = max(0, max_queue)
+        self.max_wait = max_wait
+        # По умолчанию один пользователь занимает не больше половины слотов и очереди
+        self.per_user = per_user or max(1, self.max_concurrent // 2)
+        self.per_user_queue = per_user_queue or max(1, self.max_queue // 2)
+
+        self._lock = threading.Lock()
+        self._active = 0
+        self._in_flight = defaultdict(int)
+        self._waiters = []
+        self._seq = itertools.count()
+        self._service_time = 1.0
+        self._counts = defaultdict(int)
+
+    def retry_after(self):
+        """Оценка в секундах, когда стоит повторить: очередь делится на число слотов."""
+        return max(1, math.ceil(self._service_time * (len(self._waiters) + 1) / self.max_concurrent))
+
+    def slots_for(self, weight):
+        """Сколько слотов займет запрос веса weight: не больше доли одного пользователя."""
+        return max(1, min(weight, self.max_concurrent, self.per_user))
+
+    def _fits(self, user, slots):
+        return (self._active + slots <= self.max_concurrent
+                and self._in_flight.get(user, 0) + slots <= self.per_user)
+
+    def _eligible_waiters(self):
+        """Ожидающие, которых не держит доля их пользователя."""
+        return [waiter for waiter in self._waiters
+                if self._in_flight.get(waiter.user, 0) + waiter.slots <= self.per_user]
+
+    def _admit(self, user, slots):
+        self._active += slots
+        self._in_flight[user] += slots
+
+    def _reject(self, status, reason):
+        self._counts[reason] += 1
+        metrics.inc('admission_requests_total', (('limiter', self.name), ('result', reason)))
+        raise Rejected(status, reason, self.retry_after())
+
+    def acquire(self, user, weight=1, wait=True):
+        """Занимает slots_for(weight) слотов или бросает Rejected; возвращает момент начала обработки.
+
+        Вес больше единицы у запросов, которые сами распараллеливают работу
+        (пакетный рендеринг в пул процессов). С wait=False запрос в очередь
+        не встает: нет свободных слотов - сразу 503.
+        """
+        started = time.monotonic()
+        slots = self.slots_for(weight)
+        with self._lock:
+            # Без очереди проходим, только если никто из ожидающих не может занять слоты раньше
+            if self._fits(user, slots) and not self._eligible_waiters():
+                self._admit(user, slots)
+                self._counts['admitted'] += 1
+                metrics.inc('admission_requests_total', (('limiter', self.name), ('result', 'admitted')))
+                return started
+            if not wait:
+                self._reject(503, 'busy')
+            if len(self._waiters) >= self.max_queue:
+                self._reject(503, 'queue_full')
+            if sum(1 for waiter in self._waiters if waiter.user == user) >= self.per_user_queue:
+                self._reject(429, 'user_limit')
+            waiter = _Waiter(user, next(self._seq), slots)
+            self._waiters.append(waiter)
+
+        waiter.event.wait(self.max_wait)
+        with self._lock:
+            if not waiter.granted:
+                self._waiters.remove(waiter)
+                # Под ушедшего могли копиться слоты: отдаем их остальным
+                self._grant()
+                self._reject(503, 'timeout')
+            self._counts['admitted'] += 1
+            self._counts['queued'] += 1
+        waited = time.monotonic() - started
+        metrics.observe('admission_wait_seconds', waited, (('limiter', self.name),))
+        metrics.inc('admission_requests_total', (('limiter', self.name), ('result', 'admitted')))
+        return time.monotonic()
+
+    def release(self, user, started=None, weight=1):
+        slots = self.slots_for(weight)
+        with self._lock:
+            self._active -= slots
+            self._in_flight[user] -= slots
+            if not self._in_flight[user]:
+                del self._in_flight[user]
+            if started is not None:
+                elapsed = time.monotonic() - started
+                self._service_time += SERVICE_TIME_SMOOTHING * (elapsed - self._service_time)
+            self._grant()
+
+    def _grant(self):
+        # Следующий слот - ожидающему с наименьшим числом запросов в работе, при равенстве - старшему.
+        # Если ему не хватает свободных слотов, они копятся для него, а не уходят легким запросам
+        while self._waiters:
+            eligible = self._eligible_waiters()
+            if not eligible:
+                return
+            waiter = min(eligible, key=lambda item: (self._in_flight.get(item.user, 0), item.seq))
+            if self._active + waiter.slots > self.max_concurrent:
+                return
+            self._waiters.remove(waiter)
+            self._admit(waiter.user, waiter.slots)
+            waiter.granted = True
+            waiter.event.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'name': self.name,
+                'max_concurrent': self.max_concurrent,
+                'max_queue': self.max_queue,
+                'max_wait': self.max_wait,
+                'per_user': self.per_user,
+                'per_user_queue': self.per_user_queue,
+                'active': self._active,
+                'queued': len(self._waiters),
+                'users_in_flight': len(self._in_flight),
+                'avg_service_seconds': round(self._service_time, 4),
+                'counts': dict(self._counts),
+            }
+
+
+def _once(f, *args):
+    """f(*args), вызываемая не больше одного раза: close тела могут позвать дважды."""
+    called = []
+
+    def call():
+        if not called:
+            called.append(True)
+            f(*args)
+
+    return call
+
+
+def limit_concurrency(get_limiter, identify, weight=None):
+    """Декоратор Flask-маршрута: слот лимитера на время запроса.
+
+    get_limiter() возвращает лимитер (у фабрики приложений он свой на каждое
+    приложение), identify() - пользователя для честного деления слотов,
+    weight() - сколько слотов стоит запрос (по умолчанию один). У потоковых
+    ответов, которые работают по ходу отдачи, слоты освобождаются, когда
+    ответ дописан до конца.
+    """
+    from flask import jsonify, request
+
+    def decorator(f):
+        @functools.wraps(f)
+        def decorated(*args, **kwargs):
+            limiter = get_limiter()
+            user = identify()
+            cost = weight() if weight is not None else 1
+            try:
+                started = limiter.acquire(user, cost, wait=request.environ.get('wsgi.multithread', False))
+            except Rejected as e:
+                response = jsonify({'error': 'Server is busy, retry later', 'reason': e.reason})
+                response.status_code = e.status
+                response.headers['Retry-After'] = str(e.retry_after)
+                return response
+
+            try:
+                result = f(*args, **kwargs)
+            except BaseException:
+                limiter.release(user, started, cost)
+                raise
+            response = result[0] if isinstance(result, tuple) else result
+            if getattr(response, 'is_streamed', False) and not response.direct_passthrough:
+                # Тело-генератор выполняет работу по ходу отдачи; Response.close зовет сервер
+                response.call_on_close(_once(limiter.release, user, started, cost))
+            else:
+                # У send_file (direct_passthrough) работа уже сделана, осталось отдать файл:
+                # слот не держим, а тело остается wsgi.file_wrapper сервера
+                limiter.release(user, started, cost)
+            return result
+
+        return decorated
+
+    return decorator
@@ -0,0 +1,132 @@
+from collections import OrderedDict
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import tempfile
+import threading
+import time
+
+from Services.storage import PROJECT_ROOT
+
+TOKEN_TTL = 15 * 60  # Время жизни выданного токена, секунд
+CREDENTIAL_CACHE_TTL = 60  # Сколько помним уже проверенную пару логин/пароль, секунд
+CREDENTIAL_CACHE_SIZE = 1024
+# Ключ развертывания, если SECRET_KEY не задан; общий для main.py и Document_api
+SECRET_KEY_FILE = os.environ.get('SECRET_KEY_FILE') or os.path.join(PROJECT_ROOT, 'DB', 'secret_key')
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(data):
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+def load_secret_key(path=SECRET_KEY_FILE):
+    """SECRET_KEY из окружения, иначе случайный ключ развертывания из файла path.
+
+    Зашитого ключа по умолчанию нет: с ним любой подписал бы токен за любого
+    пользователя. Файл создается при первом запуске и читается всеми
+    процессами обоих приложений, поэтому токен одного принимает другое.
+    """
+    secret = os.environ.get('SECRET_KEY')
+    if secret:
+        return secret
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))  # Права 0600
+        try:
+            with os.fdopen(fd, 'w', encoding='ascii') as key_file:
+                key_file.write(secrets.token_hex(32))
+            # link не перезаписывает: из одновременно стартующих процессов побеждает один
+            os.link(temp_path, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.unlink(temp_path)
+    with open(path, encoding='ascii') as key_file:
+        secret = key_file.read().strip()
+    if not secret:
+        raise RuntimeError(f'Secret key file {path} is empty; set SECRET_KEY or remove the file')
+    return secret
+
+
+def _sign(secret, payload):
+    return hmac.new(secret.encode('utf-8'), payload.encode('ascii'), hashlib.sha256).digest()
+
+
+def issue_token(username, secret, ttl=TOKEN_TTL):
+    """Выдает токен вида payload.signature, подписанный HMAC-SHA256."""
+    payload = _b64encode(json.dumps({'sub': username, 'exp': int(time.time()) + ttl}).encode('utf-8'))
+    return f"{payload}.{_b64encode(_sign(secret, payload))}"
+
+
+def verify_token(token, secret):
+    """Возвращает имя пользователя из действующего токена или None."""
+    try:
+        payload, signature = token.split('.', 1)
+        if not hmac.compare_digest(_b64decode(signature), _sign(secret, payload)):
+            return None
+        claims = json.loads(_b64decode(payload))
+    except (ValueError, UnicodeError):
+        return None
+    if not isinstance(claims, dict) or claims.get('exp', 0) < time.time():
+        return None
+    return claims.get('sub')
+
+
+def bearer_token(request):
+    """Токен из заголовка Authorization: Bearer <token>, если он есть."""
+    header = request.headers.get('Authorization', '')
+    scheme, _, token = header.partition(' ')
+    if scheme.lower() == 'bearer' and token:
+        return token.strip()
+    return None
+
+
+class CredentialCache:
+    """Ограниченный по размеру и времени кэш успешно проверенных Basic-учеток.
+
+    Хранит не пароль, а HMAC от логина, пароля и текущего хэша пароля из БД,
+    поэтому повторный запрос с теми же данными обходится без медленного
+    хэширования, а смена пароля действует сразу.
+    """
+
+    def __init__(self, secret, ttl=CREDENTIAL_CACHE_TTL, maxsize=CREDENTIAL_CACHE_SIZE):
+        self.secret = secret
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _digest(self, username, password, password_hash):
+        message = f"{username}\0{password}\0{password_hash}".encode('utf-8')
+        return hmac.new(self.secret.encode('utf-8'), message, hashlib.sha256).digest()
+
+    def check(self, username, password, password_hash):
+        digest = self._digest(username, password, password_hash)
+        with self._lock:
+            expires = self._entries.get(digest)
+            if expires is None:
+                return False
+            if expires < time.monotonic():
+                del self._entries[digest]
+                return False
+            self._entries.move_to_end(digest)
+            return True
+
+    def add(self, username, password, password_hash):
+        digest = self._digest(username, password, password_hash)
+        with self._lock:
+            self._entries[digest] = time.monotonic() + self.ttl
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,115 @@
+from array import array
+import datetime
+import threading
+
+MAX_CACHED_YEARS = 64
+# Календарю года нужны 1 января следующего года, а workalendar - соседние годы
+MIN_YEAR = datetime.MINYEAR + 1
+MAX_YEAR = datetime.MAXYEAR - 1
+
+
+class YearCalendar:
+    """Производственный календарь одного года, посчитанный заранее.
+
+    working[i] - рабочий ли i-й день года (с нуля), prefix[i] - сколько
+    рабочих дней среди первых i дней. Для каждого месяца запоминаются
+    первый и последний рабочий день, поэтому все ответы - O(1).
+    """
+
+    def __init__(self, year, is_working_day):
+        self.year = year
+        self.start = datetime.date(year, 1, 1)
+        days = (datetime.date(year + 1, 1, 1) - self.start).days
+
+        self.working = bytearray(days)
+        self.prefix = array('H', [0]) * (days + 1)
+        for index in range(days):
+            if is_working_day(self.start + datetime.timedelta(days=index)):
+                self.working[index] = 1
+            self.prefix[index + 1] = self.prefix[index] + self.working[index]
+
+        # {месяц: (первый рабочий день, последний рабочий день)} или None, если рабочих дней нет
+        self.month_bounds = {}
+        for month in range(1, 13):
+            first_index = self.index(datetime.date(year, month, 1))
+            end_index = self.index(datetime.date(year, month + 1, 1)) if month < 12 else days
+            first = self.working.find(1, first_index, end_index)
+            last = self.working.rfind(1, first_index, end_index)
+            self.month_bounds[month] = (
+                (self.start + datetime.timedelta(days=first), self.start + datetime.timedelta(days=last))
+                if first != -1 else None
+            )
+
+    @property
+    def total(self):
+        return self.prefix[-1]
+
+    def index(self, date):
+        return (date - self.start).days
+
+    def count(self, start, end):
+        """Число рабочих дней с start по end включительно, обе даты в этом году."""
+        return self.prefix[self.index(end) + 1] - self.prefix[self.index(start)]
+
+
+class ProductionCalendar:
+    """Ленивый кэш годовых календарей поверх workalendar."""
+
+    def __init__(self, calendar_factory=None):
+        self._calendar_factory = calendar_factory
+        self._calendar = None
+        self._years = {}
+        self._lock = threading.Lock()
+
+    def _is_working_day(self, date):
+        if self._calendar is None:
+            if self._calendar_factory is None:
+                # workalendar тяжелый, поэтому грузим его только при первом расчете года
+                from workalendar.europe import Russia
+                self._calendar_factory = Russia
+            self._calendar = self._calendar_factory()
+        return self._calendar.is_working_day(date)
+
+    def year(self, year):
+        year_calendar = self._years.get(year)
+        if year_calendar is None and not MIN_YEAR <= year <= MAX_YEAR:
+            raise ValueError(f'year must be in {MIN_YEAR}..{MAX_YEAR}')
+        if year_calendar is None:
+            with self._lock:
+                year_calendar = self._years.get(year)
+                if year_calendar is None:
+                    if len(self._years) >= MAX_CACHED_YEARS:
+                        self._years.clear()
+                    year_calendar = YearCalendar(year, self._is_working_day)
+                    self._years[year] = year_calendar
+        return year_calendar
+
+    def is_working_day(self, date):
+        year_calendar = self.year(date.year)
+        return bool(year_calendar.working[year_calendar.index(date)])
+
+    def month_bounds(self, year, month):
+        """(первый рабочий день, последний рабочий день) месяца или None."""
+        if not 1 <= month <= 12:
+            raise ValueError('month must be in 1..12')
+        return self.year(year).month_bounds[month]
+
+    def month_count(self, year, month):
+        bounds = self.month_bounds(year, month)
+        if bounds is None:
+            return 0
+        return self.year(year).count(bounds[0], bounds[1])
+
+    def count(self, start, end):
+        """Число рабочих дней с start по end включительно."""
+        if start > end:
+            return 0
+        if start.year == end.year:
+            return self.year(start.year).count(start, end)
+        total = self.year(start.year).count(start, datetime.date(start.year, 12, 31))
+        for year in range(start.year + 1, end.year):
+            total += self.year(year).total
+        return total + self.year(end.year).count(datetime.date(end.year, 1, 1), end)
+
+
+production_calendar = ProductionCalendar()
@@ -1,24 +1,386 @@
 from docx import Document
+from docx.opc.constants import CONTENT_TYPE as CT
+from docx.opc.oxml import serialize_part_xml
+from docx.opc.part import PartFactory, XmlPart
+from docx.oxml.ns import qn
+from bisect import bisect_right
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache, partial
+import copy
+import hashlib
+import multiprocessing
+import re
 import io
+import os
 import base64
+import threading
+import zipfile
 
-def process_document(template_path, placeholders):
-    try:
-        document = Document(template_path)
+from Services.docx_writer import RawZipTemplate, UnsupportedTemplate
+from Services.metrics import metrics, phase_timer
+from Services.render_cache import get_render_cache, render_key
+
+TEMPLATE_CACHE_SIZE = 32  # Сколько скомпилированных шаблонов держим в памяти
+LOCATIONS_CACHE_SIZE = 64  # Сколько разных наборов плейсхолдеров помним на один шаблон
+
+
+# Части пакета, в которых может встретиться текст документа
+STORY_CONTENT_TYPES = {
+    CT.WML_DOCUMENT_MAIN,
+    CT.WML_HEADER,
+    CT.WML_FOOTER,
+    CT.WML_FOOTNOTES,
+    CT.WML_ENDNOTES,
+    CT.WML_COMMENTS,
+}
+
+# python-docx загружает сноски как бинарные части, а нам нужно их дерево XML
+for _content_type in (CT.WML_FOOTNOTES, CT.WML_ENDNOTES):
+    PartFactory.part_type_for.setdefault(_content_type, XmlPart)
+
+W_P = qn('w:p')
+W_T = qn('w:t')
+XML_SPACE = qn('xml:space')
+
+
+def iter_story_parts(package):
+    """Перебирает (имя части, часть) для всех частей документа с текстом."""
+    for part in package.iter_parts():
+        if part.content_type in STORY_CONTENT_TYPES and isinstance(part, XmlPart):
+            yield str(part.partname), part
+
+
+def paragraph_text_nodes(paragraph):
+    """Узлы w:t абзаца, без текста вложенных абзацев (надписи, фигуры)."""
+    nodes = []
+    for node in paragraph.iter(W_T):
+        parent = node.getparent()
+        while parent is not None and parent.tag != W_P:
+            parent = parent.getparent()
+        if parent is paragraph:
+            nodes.append(node)
+    return nodes
+
+
+@lru_cache(maxsize=256)
+def compile_placeholders(placeholders):
+    """Одно регулярное выражение на весь набор плейсхолдеров, длинные ключи первыми."""
+    keys = sorted((key for key in placeholders if key), key=len, reverse=True)
+    if not keys:
+        return None
+    return re.compile('|'.join(re.escape(key) for key in keys))
+
+
+class CompiledTemplate:
+    """Разобранный один раз шаблон с индексом текста абзацев и смещений runs."""
+
+    def __init__(self, path, mtime, document, blob=None):
+        self.path = path
+        self.mtime = mtime
+        self.document = document  # Эталонный документ, напрямую никогда не изменяется
+        self.story_parts = dict(iter_story_parts(document.part.package))
+        # Сжатые члены ZIP шаблона для записи без пересжатия; None - сохраняем через python-docx
+        self.raw_zip = None
+        if blob is not None:
+            try:
+                raw_zip = RawZipTemplate(blob)
+            except (UnsupportedTemplate, zipfile.BadZipFile):
+                raw_zip = None
+            if raw_zip is not None and all(name.lstrip('/') in raw_zip.names for name in self.story_parts):
+                self.raw_zip = raw_zip
+        # {имя части: [(номер абзаца в части, текст абзаца, смещения начала каждого w:t)]}
+        self.paragraphs = {}
+        for partname, part in self.story_parts.items():
+            entries = []
+            for index, paragraph in enumerate(part.element.iter(W_P)):
+                texts = [node.text or '' for node in paragraph_text_nodes(paragraph)]
+                offsets = []
+                position = 0
+                for text in texts:
+                    offsets.append(position)
+                    position += len(text)
+                if position:
+                    entries.append((index, ''.join(texts), offsets))
+            if entries:
+                self.paragraphs[partname] = entries
+        self._locations = {}
+        self._lock = threading.Lock()
+
+    def locate(self, placeholders, parts=None):
+        """Возвращает {имя части: {номер абзаца: [(начало, конец, плейсхолдер), ...]}}.
+
+        parts - имена частей из манифеста шаблона; остальные части не просматриваются.
+        """
+        key = (tuple(sorted(placeholders)), parts)
+        with self._lock:
+            locations = self._locations.get(key)
+        if locations is not None:
+            return locations
+
+        locations = {}
+        pattern = compile_placeholders(key[0])
+        if pattern is not None:
+            for partname, entries in self.paragraphs.items():
+                if parts is not None and partname not in parts:
+                    continue
+                for index, text, offsets in entries:
+                    matches = [(m.start(), m.end(), m.group()) for m in pattern.finditer(text)]
+                    if matches:
+                        locations.setdefault(partname, {})[index] = matches
+
+        with self._lock:
+            if len(self._locations) >= LOCATIONS_CACHE_SIZE:
+                self._locations.clear()
+            self._locations[key] = locations
+        return locations
+
+    def new_document(self):
+        # Копия дерева XML в памяти в разы дешевле повторной распаковки и разбора .docx.
+        # Копируем пакет целиком, а не объект Document: его закэшированные обертки
+        # держат ссылки на вложенные элементы, которые deepcopy оторвал бы от дерева.
+        package = copy.deepcopy(self.document.part.package)
+        return package.main_document_part.document
+
+
+def replace_in_paragraph(paragraph, matches, placeholders):
+    """Заменяет совпадения, даже разбитые Word на несколько runs.
+
+    Значение пишется в run, где начинается плейсхолдер, и наследует его
+    форматирование; остаток плейсхолдера вырезается из следующих runs.
+    """
+    nodes = paragraph_text_nodes(paragraph)
+    texts = [node.text or '' for node in nodes]
+    starts = []
+    position = 0
+    for text in texts:
+        starts.append(position)
+        position += len(text)
+
+    # С конца абзаца, чтобы смещения еще не обработанных совпадений не сдвигались
+    for start, end, placeholder in reversed(matches):
+        first = bisect_right(starts, start) - 1
+        last = bisect_right(starts, end - 1) - 1
+        value = str(placeholders[placeholder])
+        head = texts[first][:start - starts[first]]
+        tail = texts[last][end - starts[last]:]
+        if first == last:
+            texts[first] = head + value + tail
+        else:
+            texts[first] = head + value
+            for middle in range(first + 1, last):
+                texts[middle] = ''
+            texts[last] = tail
+
+    for node, text in zip(nodes, texts):
+        if node.text != text:
+            node.text = text
+            node.set(XML_SPACE, 'preserve')
+
+
+_template_cache = OrderedDict()
+_template_cache_lock = threading.Lock()
+_content_hashes = OrderedDict()  # (путь, mtime) -> SHA-256 файла шаблона
+
+
+def remember_content_hash(key, content_hash):
+    with _template_cache_lock:
+        _content_hashes[key] = content_hash
+        _content_hashes.move_to_end(key)
+        while len(_content_hashes) > TEMPLATE_CACHE_SIZE * 32:
+            _content_hashes.popitem(last=False)
+
+
+def template_content_hash(template_path):
+    """SHA-256 содержимого шаблона; файл перечитывается, только если изменился его mtime."""
+    path = os.path.abspath(template_path)
+    key = (path, os.stat(path).st_mtime_ns)
+    with _template_cache_lock:
+        content_hash = _content_hashes.get(key)
+    if content_hash is None:
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as template_file:
+            for chunk in iter(lambda: template_file.read(1024 * 1024), b''):
+                sha256.update(chunk)
+        content_hash = sha256.hexdigest()
+        remember_content_hash(key, content_hash)
+    return content_hash
+
+
+def get_compiled_template(template_path):
+    path = os.path.abspath(template_path)
+    key = (path, os.stat(path).st_mtime_ns)
 
-        for paragraph in document.paragraphs:
-            for placeholder, value in placeholders.items():
-                if placeholder in paragraph.text:
-                    paragraph.text = paragraph.text.replace(placeholder, value)
+    with _template_cache_lock:
+        compiled = _template_cache.get(key)
+        if compiled is not None:
+            _template_cache.move_to_end(key)
+            return compiled
 
+    with open(path, 'rb') as template_file:
+        blob = template_file.read()
+    remember_content_hash(key, hashlib.sha256(blob).hexdigest())
+    compiled = CompiledTemplate(path, key[1], Document(io.BytesIO(blob)), blob)
+
+    with _template_cache_lock:
+        # Старые версии того же файла больше не понадобятся
+        for stale in [k for k in _template_cache if k[0] == path]:
+            del _template_cache[stale]
+        _template_cache[key] = compiled
+        while len(_template_cache) > TEMPLATE_CACHE_SIZE:
+            _template_cache.popitem(last=False)
+    return compiled
+
+
+def invalidate_template(template_path=None):
+    """Сбрасывает кэш для одного шаблона или целиком, если путь не указан."""
+    with _template_cache_lock:
+        if template_path is None:
+            _template_cache.clear()
+            _content_hashes.clear()
+            return
+        path = os.path.abspath(template_path)
+        for key in [k for k in _template_cache if k[0] == path]:
+            del _template_cache[key]
+        for key in [k for k in _content_hashes if k[0] == path]:
+            del _content_hashes[key]
+
+
+def render_document(template_path, placeholders, parts=None):
+    """Рендерит шаблон и возвращает готовый .docx в виде bytes.
+
+    Повторный запрос того же шаблона с теми же значениями отдается из
+    render_cache без обращения к python-docx. parts сужает поиск
+    плейсхолдеров до частей из манифеста.
+    """
+    render_cache = get_render_cache()
+    cache_key = render_key(template_content_hash(template_path), placeholders)
+    document_bytes = render_cache.get(cache_key)
+    if document_bytes is not None:
+        metrics.inc('render_cache_requests_total', (('result', 'hit'),))
+        return document_bytes
+    metrics.inc('render_cache_requests_total', (('result', 'miss'),))
+
+    document_bytes = _render_uncached(template_path, placeholders, parts)
+    render_cache.set(cache_key, document_bytes)
+    return document_bytes
+
+
+def _render_uncached(template_path, placeholders, parts=None):
+    with phase_timer('load'):
+        compiled = get_compiled_template(template_path)
+        # Копия пакета python-docx нужна только шаблонам, которые нельзя пропатчить в ZIP
+        document = compiled.new_document() if compiled.raw_zip is None else None
+    if document is None:
+        return _render_patched(compiled, placeholders, parts)
+
+    with phase_timer('substitute'):
+        locations = compiled.locate(placeholders, parts)
+        for partname, part in iter_story_parts(document.part.package):
+            if partname not in locations:
+                continue
+            part_matches = locations[partname]
+            for index, paragraph in enumerate(part.element.iter(W_P)):
+                if index in part_matches:
+                    replace_in_paragraph(paragraph, part_matches[index], placeholders)
+
+    with phase_timer('save'):
         output = io.BytesIO()
         document.save(output)
-        output.seek(0)
+        return output.getvalue()
+
+
+def _render_patched(compiled, placeholders, parts):
+    """Копирует только измененные части шаблона и пересобирает ZIP без пересжатия остальных."""
+    with phase_timer('substitute'):
+        changed = {}
+        for partname, part_matches in compiled.locate(placeholders, parts).items():
+            element = copy.deepcopy(compiled.story_parts[partname].element)
+            for index, paragraph in enumerate(element.iter(W_P)):
+                if index in part_matches:
+                    replace_in_paragraph(paragraph, part_matches[index], placeholders)
+            changed[partname.lstrip('/')] = element
 
-        # Вернуть файл в формате base64 encoded строки
-        base64_pdf = base64.b64encode(output.read()).decode('utf-8')
+    with phase_timer('save'):
+        return compiled.raw_zip.write({name: serialize_part_xml(element) for name, element in changed.items()})
 
-        return base64_pdf
 
-    except Exception as e:
+def encode_document(document_bytes):
+    # Вернуть файл в формате base64 encoded строки
+    with phase_timer('encode'):
+        return base64.b64encode(document_bytes).decode('ascii')
+
+
+def process_document(template_path, placeholders):
+    try:
+        return encode_document(render_document(template_path, placeholders))
+
+    except Exception:
         raise # Re-raise the exception to be caught in the route
+
+
+_render_pool = None
+_render_pool_lock = threading.Lock()
+# fork из многопоточного веб-процесса копирует чужие захваченные блокировки
+# (логирование, SQLAlchemy, кэши) и может повесить дочерний процесс
+RENDER_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+
+def get_render_pool(max_workers=None):
+    """Общий пул процессов для рендеринга: python-docx упирается в CPU и GIL."""
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None:
+            _render_pool = ProcessPoolExecutor(
+                max_workers=max_workers, mp_context=multiprocessing.get_context(RENDER_START_METHOD)
+            )
+        return _render_pool
+
+
+def _forget_render_pool(pool):
+    # Умерший процесс ломает весь пул навсегда: следующий get_render_pool создаст новый
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is pool:
+            _render_pool = None
+
+
+def _check_render_pool(pool, future):
+    if not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+        _forget_render_pool(pool)
+
+
+def submit_render(template_path, placeholders, max_workers=None):
+    """Future с render_document в общем пуле; сломанный пул заменяется новым.
+
+    Задание, на котором пул сломался, не повторяется (оно могло его и уронить):
+    его future завершается BrokenProcessPool, а следующие идут в новый пул.
+    """
+    pool = get_render_pool(max_workers)
+    try:
+        future = pool.submit(render_document, template_path, placeholders)
+    except BrokenProcessPool:
+        _forget_render_pool(pool)
+        pool = get_render_pool(max_workers)
+        future = pool.submit(render_document, template_path, placeholders)
+    future.add_done_callback(partial(_check_render_pool, pool))
+    return future
+
+
+def render_many(jobs, max_workers=None):
+    """Рендерит [(template_path, placeholders), ...] параллельно.
+
+    Отдает (индекс задания, bytes или исключение) по мере готовности,
+    а не в исходном порядке.
+    """
+    futures = {
+        submit_render(template_path, placeholders, max_workers): index
+        for index, (template_path, placeholders) in enumerate(jobs)
+    }
+    for future in as_completed(futures):
+        index = futures.pop(future)
+        try:
+            yield index, future.result()
+        except Exception as e:
+            yield index, e
@@ -0,0 +1,133 @@
+"""Запись .docx без повторного сжатия неизмененных частей.
+
+ZIP-члены шаблона (картинки, стили, шрифты) копируются как есть, в уже
+сжатом виде; заново сериализуются и сжимаются только части, в которых
+была подстановка. Локальные записи неизмененных членов собираются один
+раз при разборе шаблона, поэтому рендеринг сводится к склейке готовых
+кусков байтов.
+"""
+import io
+import struct
+import zipfile
+import zlib
+
+LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+CENTRAL_HEADER = struct.Struct('<4s4B4HL2L5H2L')
+END_RECORD = struct.Struct('<4s4H2LH')
+
+LOCAL_SIGNATURE = b'PK\x03\x04'
+CENTRAL_SIGNATURE = b'PK\x01\x02'
+END_SIGNATURE = b'PK\x05\x06'
+
+DATA_DESCRIPTOR_FLAG = 0x08  # Размеры после данных; мы пишем их сразу в заголовок
+ENCRYPTED_FLAG = 0x01
+ZIP_VERSION = 20
+ZIP64_LIMIT = 0xFFFFFFFF
+DEFLATE_LEVEL = 6
+
+
+class UnsupportedTemplate(Exception):
+    """Шаблон нельзя копировать по членам (ZIP64, шифрование); нужен обычный save()."""
+
+
+def _dos_datetime(date_time):
+    year, month, day, hour, minute, second = date_time
+    return (hour << 11) | (minute << 5) | (second // 2), ((year - 1980) << 9) | (month << 5) | day
+
+
+class _Member:
+    __slots__ = ('name', 'flags', 'method', 'time', 'date', 'crc', 'compressed_size', 'size',
+                 'external_attr', 'record')
+
+
+class RawZipTemplate:
+    """Разобранный ZIP шаблона: члены в исходном порядке с готовыми локальными записями."""
+
+    def __init__(self, blob):
+        self.members = []
+        self.names = set()
+        with zipfile.ZipFile(io.BytesIO(blob)) as archive:
+            infos = archive.infolist()
+        if len(infos) >= 0xFFFF:
+            raise UnsupportedTemplate('Too many ZIP members')
+
+        view = memoryview(blob)
+        for info in infos:
+            if info.flag_bits & ENCRYPTED_FLAG:
+                raise UnsupportedTemplate(f'Encrypted member {info.filename}')
+            if info.header_offset >= ZIP64_LIMIT or info.compress_size >= ZIP64_LIMIT or info.file_size >= ZIP64_LIMIT:
+                raise UnsupportedTemplate(f'ZIP64 member {info.filename}')
+
+            fields = LOCAL_HEADER.unpack_from(blob, info.header_offset)
+            if fields[0] != LOCAL_SIGNATURE:
+                raise UnsupportedTemplate(f'Bad local header for {info.filename}')
+            name_start = info.header_offset + LOCAL_HEADER.size
+            name_length, extra_length = fields[10], fields[11]
+            data_start = name_start + name_length + extra_length
+
+            member = _Member()
+            member.name = bytes(view[name_start:name_start + name_length])
+            member.flags = info.flag_bits & ~DATA_DESCRIPTOR_FLAG
+            member.method = info.compress_type
+            member.time, member.date = _dos_datetime(info.date_time)
+            member.crc = info.CRC
+            member.compressed_size = info.compress_size
+            member.size = info.file_size
+            member.external_attr = info.external_attr
+            # Заголовок без extra-полей плюс сжатые данные как есть
+            member.record = self._local_header(member) + member.name + bytes(
+                view[data_start:data_start + info.compress_size]
+            )
+            self.members.append(member)
+            self.names.add(info.filename)
+
+    @staticmethod
+    def _local_header(member):
+        return LOCAL_HEADER.pack(
+            LOCAL_SIGNATURE, ZIP_VERSION, 0, member.flags, member.method, member.time, member.date,
+            member.crc, member.compressed_size, member.size, len(member.name), 0,
+        )
+
+    def iter_chunks(self, replacements):
+        """Куски нового .docx: {имя члена: новые несжатые bytes} подставляются, остальное копируется."""
+        offset = 0
+        central = []
+        for member in self.members:
+            data = replacements.get(member.name.decode('utf-8' if member.flags & 0x800 else 'cp437'))
+            if data is None:
+                record = member.record
+                central.append((member, offset))
+                yield record
+                offset += len(record)
+                continue
+
+            compressor = zlib.compressobj(DEFLATE_LEVEL, zlib.DEFLATED, -15)
+            compressed = compressor.compress(data) + compressor.flush()
+            changed = _Member()
+            changed.name = member.name
+            changed.flags = member.flags
+            changed.method = zipfile.ZIP_DEFLATED
+            changed.time, changed.date = member.time, member.date
+            changed.crc = zlib.crc32(data)
+            changed.compressed_size = len(compressed)
+            changed.size = len(data)
+            changed.external_attr = member.external_attr
+            header = self._local_header(changed) + changed.name
+            central.append((changed, offset))
+            yield header
+            yield compressed
+            offset += len(header) + len(compressed)
+
+        directory = b''.join(
+            CENTRAL_HEADER.pack(
+                CENTRAL_SIGNATURE, ZIP_VERSION, 0, ZIP_VERSION, 0, member.flags, member.method,
+                member.time, member.date, member.crc, member.compressed_size, member.size,
+                len(member.name), 0, 0, 0, 0, member.external_attr, member_offset,
+            ) + member.name
+            for member, member_offset in central
+        )
+        yield directory
+        yield END_RECORD.pack(END_SIGNATURE, 0, 0, len(central), len(central), len(directory), offset, 0)
+
+    def write(self, replacements):
+        return b''.join(self.iter_chunks(replacements))
@@ -0,0 +1,190 @@
+"""Массовая загрузка справочников из CSV или NDJSON: сотрудники, юрлица, типы документов.
+
+Строки читаются из потока запроса по одной, проверяются и копятся в пачки по
+IMPORT_BATCH_SIZE. Каждая пачка - один UPSERT через executemany в своей
+транзакции, поэтому десятки тысяч строк грузятся за секунды, а блокировка
+записи SQLite не держится на весь файл. Ошибочная строка не отменяет
+остальные: она попадает в отчет с номером строки исходного файла.
+"""
+import csv
+import io
+import json
+import os
+
+from sqlalchemy import column, func, table
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+IMPORT_BATCH_SIZE = 1000
+IMPORT_MAX_ERRORS = 100  # Сколько ошибок попадает в отчет; считаются все
+IMPORT_FORMATS = {
+    'text/csv': 'csv',
+    'application/x-ndjson': 'ndjson',
+    'application/jsonl': 'ndjson',
+}
+IMPORT_EXTENSIONS = {'.csv': 'csv', '.ndjson': 'ndjson', '.jsonl': 'ndjson'}
+CSV_DELIMITERS = (',', ';', '\t')  # Excel в русской локали сохраняет CSV через точку с запятой
+
+# Только колонки справочников: модели у двух приложений свои
+employees_table = table("Employees", column("employee"), column("rate"))
+legal_entities_table = table("LegalEntities", column("name"), column("director"))
+doctype_table = table("Doctype", column("type"))
+
+
+def _required_text(record, name):
+    value = record.get(name)
+    if value is not None and not isinstance(value, str):
+        raise ValueError(f'{name} must be a string')
+    if not value or not value.strip():
+        raise ValueError(f'{name} is required')
+    return value.strip()
+
+
+def _optional_text(record, name):
+    value = record.get(name)
+    if value is None:
+        return ''
+    if not isinstance(value, str):
+        raise ValueError(f'{name} must be a string')
+    return value.strip()
+
+
+def _rate(record):
+    value = record.get('rate')
+    if isinstance(value, str):
+        value = value.strip()
+        if value.lstrip('-').isdigit():
+            value = int(value)
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise ValueError('rate must be an integer')
+    if value < 0:
+        raise ValueError('rate must not be negative')
+    return value
+
+
+def parse_employee(record):
+    return {'employee': _required_text(record, 'employee'), 'rate': _rate(record)}
+
+
+def parse_legal_entity(record):
+    return {'name': _required_text(record, 'name'), 'director': _optional_text(record, 'director')}
+
+
+def parse_doctype(record):
+    return {'type': _required_text(record, 'type')}
+
+
+def _employees_upsert():
+    statement = sqlite_insert(employees_table)
+    return statement.on_conflict_do_update(
+        index_elements=[employees_table.c.employee], set_={'rate': statement.excluded.rate}
+    )
+
+
+def _legal_entities_upsert():
+    # Как и /get_template: новое юрлицо без директора получает '', а пустой директор
+    # в файле не затирает уже известного
+    statement = sqlite_insert(legal_entities_table)
+    return statement.on_conflict_do_update(
+        index_elements=[legal_entities_table.c.name],
+        set_={'director': func.coalesce(func.nullif(statement.excluded.director, ''),
+                                        legal_entities_table.c.director)},
+    )
+
+
+def _doctype_upsert():
+    return sqlite_insert(doctype_table).on_conflict_do_nothing(index_elements=[doctype_table.c.type])
+
+
+# Вид справочника -> (разбор строки, UPSERT для executemany)
+IMPORT_KINDS = {
+    'employees': (parse_employee, _employees_upsert()),
+    'legal_entities': (parse_legal_entity, _legal_entities_upsert()),
+    'doctypes': (parse_doctype, _doctype_upsert()),
+}
+
+
+def detect_format(mimetype, filename=None):
+    """csv, ndjson или None по типу содержимого, а если он ничего не говорит - по расширению файла."""
+    import_format = IMPORT_FORMATS.get(mimetype)
+    if import_format is None and filename:
+        import_format = IMPORT_EXTENSIONS.get(os.path.splitext(filename)[1].lower())
+    return import_format
+
+
+def iter_records(stream, import_format):
+    """(номер строки, dict или None, ошибка или None) из бинарного потока CSV или NDJSON.
+
+    UTF-8 с BOM и без; у CSV разделитель определяется по строке заголовка.
+    Ошибка кодировки прерывает чтение исключением UnicodeDecodeError.
+    """
+    lines = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if import_format == 'ndjson':
+        for line_number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                yield line_number, None, 'Invalid JSON'
+                continue
+            if not isinstance(record, dict):
+                yield line_number, None, 'Expected a JSON object'
+                continue
+            yield line_number, record, None
+        return
+
+    header = lines.readline()
+    if not header:
+        return
+    delimiter = max(CSV_DELIMITERS, key=header.count)
+    reader = csv.DictReader(_chain_first(header, lines), delimiter=delimiter)
+    reader.fieldnames = [name.strip() for name in reader.fieldnames]
+    for record in reader:
+        if not any(value and value.strip() for value in record.values() if isinstance(value, str)):
+            continue
+        yield reader.line_num, record, None
+
+
+def _chain_first(first, rest):
+    yield first
+    yield from rest
+
+
+def import_records(session, kind, records, batch_size=IMPORT_BATCH_SIZE, max_errors=IMPORT_MAX_ERRORS):
+    """Загружает записи iter_records в справочник kind; каждая пачка коммитится отдельно.
+
+    Возвращает отчет {"imported", "failed", "errors": [{"line", "error"}]};
+    если поток нельзя дочитать, в отчете есть "error", а уже загруженные
+    пачки остаются в БД.
+    """
+    parse, statement = IMPORT_KINDS[kind]
+    report = {'imported': 0, 'failed': 0, 'errors': []}
+    batch = []
+
+    def flush():
+        session.execute(statement, batch)
+        session.commit()
+        report['imported'] += len(batch)
+        batch.clear()
+
+    try:
+        for line_number, record, error in records:
+            if error is None:
+                try:
+                    batch.append(parse(record))
+                except ValueError as e:
+                    error = str(e)
+            if error is not None:
+                report['failed'] += 1
+                if len(report['errors']) < max_errors:
+                    report['errors'].append({'line': line_number, 'error': error})
+                continue
+            if len(batch) >= batch_size:
+                flush()
+    except (UnicodeDecodeError, csv.Error) as e:
+        report['error'] = f'Cannot read input: {e}'
+    if batch:
+        flush()
+    return report
@@ -0,0 +1,49 @@
+from collections import OrderedDict
+import threading
+import time
+
+LOOKUP_CACHE_TTL = 300  # Страховка от изменений, сделанных другим процессом, секунд
+LOOKUP_CACHE_SIZE = 4096
+
+MISSING = object()
+
+
+class LookupCache:
+    """Кэш редко меняющихся справочных данных в памяти процесса.
+
+    Значение None тоже кэшируется: так запоминаются заведомые промахи.
+    Отсутствие ключа get() сообщает через MISSING.
+    """
+
+    def __init__(self, ttl=LOOKUP_CACHE_TTL, maxsize=LOOKUP_CACHE_SIZE):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return MISSING
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return MISSING
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
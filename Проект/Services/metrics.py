@@ -0,0 +1,183 @@
+from contextlib import contextmanager
+import cProfile
+import io
+import logging
+import pstats
+import random
+import threading
+import time
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+logger = logging.getLogger(__name__)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels
+    )
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+class MetricsRegistry:
+    """Счетчики и гистограммы в памяти процесса с выводом в текстовом формате Prometheus."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help = {}
+        self._counters = {}  # (имя, метки) -> значение
+        self._histograms = {}  # (имя, метки) -> [счетчики по корзинам, сумма, количество]
+        self._buckets = {}
+
+    def counter(self, name, help_text):
+        self._help[name] = ('counter', help_text)
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self._help[name] = ('histogram', help_text)
+        self._buckets[name] = tuple(buckets)
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, tuple(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        buckets = self._buckets[name]
+        key = (name, tuple(labels))
+        with self._lock:
+            entry = self._histograms.get(key)
+            if entry is None:
+                entry = self._histograms[key] = [[0] * len(buckets), 0.0, 0]
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (list(entry[0]), entry[1], entry[2]) for key, entry in self._histograms.items()}
+
+        lines = []
+        for name, (kind, help_text) in sorted(self._help.items()):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            if kind == 'counter':
+                for (metric, labels), value in sorted(counters.items()):
+                    if metric == name:
+                        lines.append(f'{name}{_format_labels(labels)} {value}')
+                continue
+            for (metric, labels), (bucket_counts, total, count) in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                for bound, bucket_count in zip(self._buckets[name], bucket_counts):
+                    lines.append(f'{name}_bucket{_format_labels(labels + (("le", bound),))} {bucket_count}')
+                lines.append(f'{name}_bucket{_format_labels(labels + (("le", "+Inf"),))} {count}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {total}')
+                lines.append(f'{name}_count{_format_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
+metrics.histogram('http_request_duration_seconds', 'Request latency by route.')
+metrics.counter('http_requests_total', 'Requests by route and status.')
+metrics.histogram('db_queries_per_request', 'SQL statements executed per request.', QUERY_COUNT_BUCKETS)
+metrics.histogram('db_query_time_per_request_seconds', 'Time spent in SQL per request.')
+metrics.counter('db_queries_total', 'SQL statements executed.')
+metrics.histogram('document_phase_duration_seconds', 'Time spent in each process_document phase.')
+metrics.counter('render_cache_requests_total', 'Rendered-document cache lookups by result.')
+
+
+@contextmanager
+def phase_timer(phase):
+    """Замеряет фазу рендеринга документа: load, substitute, save, encode."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe('document_phase_duration_seconds', time.perf_counter() - started, (('phase', phase),))
+
+
+# Запросы в БД, выполненные текущим потоком в рамках текущего HTTP-запроса
+_query_stats = threading.local()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context.metrics_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    metrics.inc('db_queries_total')
+    stats = getattr(_query_stats, 'current', None)
+    if stats is not None:
+        stats[0] += 1
+        stats[1] += time.perf_counter() - context.metrics_started
+
+
+def instrument_engine(engine):
+    from sqlalchemy import event
+
+    if not event.contains(engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def instrument_app(app, engine, slow_request_ms=None, profile_sample_rate=0.0):
+    """Вешает на Flask-приложение замеры запросов и маршрут /metrics.
+
+    Если задан slow_request_ms, запросы медленнее порога пишутся в лог; доля
+    profile_sample_rate запросов выполняется под cProfile, и для медленных
+    из них в лог попадает профиль.
+    """
+    from flask import Response, g, request
+
+    instrument_engine(engine)
+
+    @app.before_request
+    def start_request_metrics():
+        g.metrics_started = time.perf_counter()
+        _query_stats.current = [0, 0.0]
+        g.metrics_profiler = None
+        if profile_sample_rate and random.random() < profile_sample_rate:
+            g.metrics_profiler = cProfile.Profile()
+            g.metrics_profiler.enable()
+
+    @app.after_request
+    def finish_request_metrics(response):
+        started = g.pop('metrics_started', None)
+        if started is None:
+            return response
+        duration = time.perf_counter() - started
+        profiler = g.pop('metrics_profiler', None)
+        if profiler is not None:
+            profiler.disable()
+
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        labels = (('route', route), ('method', request.method))
+        metrics.observe('http_request_duration_seconds', duration, labels)
+        metrics.inc('http_requests_total', labels + (('status', response.status_code),))
+
+        stats = getattr(_query_stats, 'current', None) or [0, 0.0]
+        _query_stats.current = None
+        metrics.observe('db_queries_per_request', stats[0], labels)
+        metrics.observe('db_query_time_per_request_seconds', stats[1], labels)
+
+        if slow_request_ms is not None and duration * 1000 >= slow_request_ms:
+            message = f'Slow request {request.method} {route}: {duration * 1000:.1f} ms, {stats[0]} queries, {stats[1] * 1000:.1f} ms in SQL'
+            if profiler is not None:
+                output = io.StringIO()
+                pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(20)
+                message += '\n' + output.getvalue()
+            logger.warning(message)
+        return response
+
+    def metrics_endpoint():
+        return Response(metrics.render(), content_type=PROMETHEUS_CONTENT_TYPE)
+
+    app.add_url_rule('/metrics', 'metrics', metrics_endpoint, methods=['GET'])
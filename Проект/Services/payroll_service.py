@@ -0,0 +1,50 @@
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+
+DEFAULT_VAT_RATE = Decimal('0.05')
+HOURS_PER_DAY = Decimal('8')  # Норма часов в рабочем дне для расчета за период
+CENTS = Decimal('0.01')
+
+
+def to_decimal(value):
+    """Decimal из строки или числа; float приводится через str, чтобы не тащить двоичную погрешность."""
+    if isinstance(value, float):
+        value = str(value)
+    try:
+        result = Decimal(value)
+    except (InvalidOperation, TypeError, ValueError):
+        raise ValueError(f'Invalid number: {value!r}')
+    if not result.is_finite():
+        raise ValueError(f'Invalid number: {value!r}')
+    return result
+
+
+def calculate_payroll(employees, rates, hours, vat_rate):
+    """Считает зарплату по столбцам: имена, ставки и часы - списки одной длины.
+
+    Все суммы считаются в Decimal и округляются до копеек.
+    """
+    vat_rate = to_decimal(vat_rate if vat_rate is not None else DEFAULT_VAT_RATE)
+
+    salaries_before_vat = [
+        (to_decimal(rate) * hours_worked).quantize(CENTS, ROUND_HALF_UP)
+        for rate, hours_worked in zip(rates, hours)
+    ]
+    vat_amounts = [(salary * vat_rate).quantize(CENTS, ROUND_HALF_UP) for salary in salaries_before_vat]
+
+    # Итог складываем из уже округленных частей, чтобы сумма сходилась до копейки
+    return [
+        {
+            'employee': employee,
+            'hours': hours_worked,
+            'salary_before_vat': before,
+            'vat_rate': vat_rate,
+            'vat_amount': vat_amount,
+            'salary_with_vat': before + vat_amount,
+        }
+        for employee, hours_worked, before, vat_amount in zip(employees, hours, salaries_before_vat, vat_amounts)
+    ]
+
+
+def json_amounts(values):
+    """Копия словаря, где Decimal заменены на float: в JSON суммы уходят числами, как и раньше."""
+    return {key: float(value) if isinstance(value, Decimal) else value for key, value in values.items()}
@@ -0,0 +1,101 @@
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+RENDER_CACHE_BYTES = 64 * 1024 * 1024  # Бюджет памяти под готовые документы
+DOCX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+
+
+def render_key(template_hash, placeholders):
+    """Ключ готового документа: хэш содержимого шаблона плюс канонический хэш значений."""
+    canonical = json.dumps(placeholders, sort_keys=True, ensure_ascii=False, separators=(',', ':'), default=str)
+    return hashlib.sha256(f"{template_hash}\0{canonical}".encode('utf-8')).hexdigest()
+
+
+class RenderCache:
+    """LRU готовых .docx с ограничением по суммарному размеру в байтах.
+
+    Если задан disk_dir, документы дополнительно пишутся на диск и переживают
+    вытеснение из памяти и перезапуск процесса.
+    """
+
+    def __init__(self, max_bytes=RENDER_CACHE_BYTES, disk_dir=None):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], f"{key}.docx")
+
+    def get(self, key):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                return data
+
+        if not self.disk_dir:
+            return None
+        try:
+            with open(self._disk_path(key), 'rb') as cached_file:
+                data = cached_file.read()
+        except FileNotFoundError:
+            return None
+        self._remember(key, data)
+        return data
+
+    def set(self, key, data):
+        self._remember(key, data)
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as temp_file:
+            temp_file.write(data)
+        os.replace(temp_path, path)
+
+    def _remember(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous)
+            self._entries[key] = data
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+render_cache = RenderCache()
+
+
+def configure_render_cache(max_bytes=RENDER_CACHE_BYTES, disk_dir=None):
+    """Задает бюджет памяти и, при желании, каталог дискового уровня кэша готовых документов.
+
+    Живет здесь, а не в document_service, чтобы приложение могло настроить
+    кэш при старте, не загружая python-docx.
+    """
+    global render_cache
+    render_cache = RenderCache(max_bytes, disk_dir)
+    return render_cache
+
+
+def get_render_cache():
+    return render_cache
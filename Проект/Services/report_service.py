@@ -0,0 +1,202 @@
+"""Сводка по готовым документам: количество и сумма по юрлицу и месяцу.
+
+Таблица ReadyDocSummary обновляется в той же транзакции, что и вставка в
+ReadyDoc (при шардировании - сразу после нее), поэтому отчеты читают несколько строк сводки вместо полного
+прохода по архиву. Пересобрать сводку по истории:
+    python -m Services.report_service --rebuild
+"""
+import argparse
+import datetime
+from decimal import Decimal, InvalidOperation
+
+from sqlalchemy import Column, Integer, MetaData, String, Table, column, delete, func, insert, select, table
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from Services.sharding import defer_catalog_write
+
+# main.py хранит дату строкой из формы, поэтому понимаем оба привычных формата
+DATE_FORMATS = ('%Y-%m-%d', '%d.%m.%Y')
+REBUILD_BATCH_SIZE = 5000
+
+summary_metadata = MetaData()
+
+summary_table = Table(
+    "ReadyDocSummary", summary_metadata,
+    Column("legal_entity", String, primary_key=True),  # '' для документов без юрлица
+    Column("year", Integer, primary_key=True),
+    Column("month", Integer, primary_key=True),
+    Column("documents", Integer, nullable=False, default=0),
+    Column("total_sum", Integer, nullable=False, default=0),
+)
+
+# Только нужные для сводки колонки ReadyDoc: модели у двух приложений свои
+ready_doc_table = table("ReadyDoc", column("date"), column("legalEntities"), column("sum"))
+
+
+def parse_document_date(value):
+    """datetime.date из date или строки YYYY-MM-DD / DD.MM.YYYY; ValueError, если не разобрать."""
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    if isinstance(value, str):
+        for date_format in DATE_FORMATS:
+            try:
+                return datetime.datetime.strptime(value.strip(), date_format).date()
+            except ValueError:
+                continue
+    raise ValueError(f'Invalid date: {value!r}')
+
+
+def _parse_amount(value):
+    """Сумма документа как Decimal; нечисловая (ReadyDoc.sum примет и ее) считается нулем.
+
+    Сводка не должна ронять вставку документа, который раньше принимался.
+    """
+    if isinstance(value, float):
+        value = str(value)
+    try:
+        amount = Decimal(value if value is not None else 0)
+    except (InvalidOperation, TypeError, ValueError):
+        return Decimal(0)
+    return amount if amount.is_finite() else Decimal(0)
+
+
+def _stored_amount(amount):
+    # SQLite не принимает Decimal: целое пишем целым, дробное - REAL, как его хранит и ReadyDoc.sum
+    return int(amount) if amount == amount.to_integral_value() else float(amount)
+
+
+def _aggregate(rows):
+    """{(юрлицо, год, месяц): [документов, сумма]} из (дата, юрлицо, сумма); строки без даты пропускаются."""
+    totals = {}
+    for date, legal_entity, amount in rows:
+        try:
+            date = parse_document_date(date)
+        except ValueError:
+            continue
+        entry = totals.setdefault((legal_entity or '', date.year, date.month), [0, Decimal(0)])
+        entry[0] += 1
+        entry[1] += _parse_amount(amount)
+    return totals
+
+
+def record_documents(session, rows):
+    """Добавляет в сводку документы (дата, юрлицо, сумма) в текущей транзакции session.
+
+    При шардировании сводка в каталоге обновляется сразу после коммита
+    session отдельной короткой транзакцией (Services/sharding.py).
+    """
+    statements = []
+    for (legal_entity, year, month), (documents, total_sum) in _aggregate(rows).items():
+        statement = sqlite_insert(summary_table).values(
+            legal_entity=legal_entity, year=year, month=month, documents=documents,
+            total_sum=_stored_amount(total_sum),
+        )
+        statements.append(statement.on_conflict_do_update(
+            index_elements=[summary_table.c.legal_entity, summary_table.c.year, summary_table.c.month],
+            set_={
+                'documents': summary_table.c.documents + statement.excluded.documents,
+                'total_sum': summary_table.c.total_sum + statement.excluded.total_sum,
+            },
+        ))
+
+    def write(connection):
+        for statement in statements:
+            connection.execute(statement)
+
+    if statements and not defer_catalog_write(session, write):
+        write(session)
+
+
+def record_document(session, date, legal_entity, amount):
+    record_documents(session, [(date, legal_entity, amount)])
+
+
+def _iter_ready_docs(connection):
+    return connection.execution_options(yield_per=REBUILD_BATCH_SIZE).execute(
+        select(ready_doc_table.c.date, ready_doc_table.c.legalEntities, ready_doc_table.c.sum)
+    )
+
+
+def _aggregate_sources(sources):
+    totals = {}
+    for source in sources:
+        with source.connect() as connection:
+            for key, (documents, total_sum) in _aggregate(_iter_ready_docs(connection)).items():
+                entry = totals.setdefault(key, [0, Decimal(0)])
+                entry[0] += documents
+                entry[1] += total_sum
+    return totals
+
+
+def rebuild_summary(engine, sources=None):
+    """Пересчитывает сводку по всей таблице ReadyDoc одной транзакцией.
+
+    sources - базы с ReadyDoc, если история разнесена по шардам
+    (Services/sharding.py); по умолчанию документы берутся из самой engine.
+    """
+    with engine.begin() as connection:
+        totals = _aggregate(_iter_ready_docs(connection)) if sources is None else _aggregate_sources(sources)
+        connection.execute(delete(summary_table))
+        if totals:
+            connection.execute(insert(summary_table), [
+                {'legal_entity': legal_entity, 'year': year, 'month': month,
+                 'documents': documents, 'total_sum': _stored_amount(total_sum)}
+                for (legal_entity, year, month), (documents, total_sum) in totals.items()
+            ])
+    return len(totals)
+
+
+def ensure_summary(engine):
+    """Создает таблицу сводки и заполняет ее по истории, если она пуста, а документы уже есть."""
+    summary_metadata.create_all(engine)
+    with engine.connect() as connection:
+        has_summary = connection.execute(select(summary_table.c.year).limit(1)).first() is not None
+        has_documents = connection.execute(select(func.count()).select_from(ready_doc_table)).scalar() > 0
+    if not has_summary and has_documents:
+        rebuild_summary(engine)
+
+
+def query_summary(session, group_by='entity_month', legal_entity=None, date_from=None, date_to=None):
+    """Строки отчета из сводки; date_from и date_to - пары (год, месяц) включительно."""
+    period = summary_table.c.year * 12 + summary_table.c.month
+    keys = {
+        'entity': [summary_table.c.legal_entity],
+        'month': [summary_table.c.year, summary_table.c.month],
+        'entity_month': [summary_table.c.legal_entity, summary_table.c.year, summary_table.c.month],
+    }[group_by]
+
+    statement = select(
+        *keys,
+        func.sum(summary_table.c.documents).label('documents'),
+        func.sum(summary_table.c.total_sum).label('total_sum'),
+    ).group_by(*keys).order_by(*keys)
+    if legal_entity is not None:
+        statement = statement.where(summary_table.c.legal_entity == legal_entity)
+    if date_from:
+        statement = statement.where(period >= date_from[0] * 12 + date_from[1])
+    if date_to:
+        statement = statement.where(period <= date_to[0] * 12 + date_to[1])
+    return [dict(row._mapping) for row in session.execute(statement)]
+
+
+def main():
+    from Services.sharding import data_engines, router_from_env
+    from Services.storage import get_engine
+
+    parser = argparse.ArgumentParser(description='Сводка по ReadyDoc')
+    parser.add_argument('--rebuild', action='store_true', help='пересчитать сводку по всей истории')
+    args = parser.parse_args()
+
+    engine = get_engine()
+    if args.rebuild:
+        router = router_from_env(engine)
+        summary_metadata.create_all(engine)
+        print(f'Rebuilt {rebuild_summary(engine, data_engines(router) if router else None)} summary rows')
+    else:
+        ensure_summary(engine)
+
+
+if __name__ == '__main__':
+    main()
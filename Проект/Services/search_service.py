@@ -0,0 +1,254 @@
+"""Полнотекстовый поиск по готовым документам на SQLite FTS5.
+
+Текст документа лежит в виртуальной таблице ReadyDocText, rowid которой
+совпадает с ReadyDoc.id. Проиндексировать уже существующие файлы:
+    python -m Services.search_service --backfill
+"""
+import argparse
+import hashlib
+import io
+import os
+import re
+import threading
+import zipfile
+from collections import OrderedDict
+
+from sqlalchemy import text
+
+from Services.sharding import data_engines, router_from_env, shard_bind_arguments, shard_bind_arguments_all
+
+W_NAMESPACE = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+W_P = f'{{{W_NAMESPACE}}}p'
+W_T = f'{{{W_NAMESPACE}}}t'
+W_TAB = f'{{{W_NAMESPACE}}}tab'
+
+# Части .docx с текстом: основной документ, колонтитулы, сноски
+DOCX_TEXT_PARTS = re.compile(r'^word/(document|header\d*|footer\d*|footnotes|endnotes)\.xml$')
+TEXT_ENCODINGS = ('utf-8', 'cp1251')
+INDEXED_EXTENSIONS = {'docx', 'txt'}
+
+BACKFILL_BATCH_SIZE = 500
+DOCUMENT_TEXT_CACHE_SIZE = 256
+SEARCH_MAX_LIMIT = 100
+SNIPPET_TOKENS = 16
+
+TOKEN_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+
+def iter_docx_paragraphs(source, parts=DOCX_TEXT_PARTS):
+    """(имя части, текст абзаца) для частей .docx, чьи имена подходят под parts.
+
+    source - путь, bytes или файловый объект. Читаем XML потоком через lxml,
+    без python-docx. Имя части совпадает с partname в python-docx, например
+    /word/document.xml.
+    """
+    from lxml import etree
+
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    with zipfile.ZipFile(source) as archive:
+        for name in archive.namelist():
+            if not parts.match(name):
+                continue
+            with archive.open(name) as part:
+                current = []
+                for event, element in etree.iterparse(part, events=('end',), tag=(W_P, W_T, W_TAB)):
+                    if element.tag == W_T:
+                        current.append(element.text or '')
+                    elif element.tag == W_TAB:
+                        current.append('\t')
+                    else:
+                        if current:
+                            yield '/' + name, ''.join(current)
+                            current = []
+                        element.clear()
+
+
+def docx_text(source):
+    """Текст .docx по абзацам."""
+    return '\n'.join(text for partname, text in iter_docx_paragraphs(source))
+
+
+def plain_text(data):
+    for encoding in TEXT_ENCODINGS:
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    return data.decode('utf-8', errors='replace')
+
+
+def extract_text(source, extension):
+    """Текст документа для индекса или None, если формат не индексируется или файл битый."""
+    extension = (extension or '').lower().lstrip('.')
+    if extension not in INDEXED_EXTENSIONS:
+        return None
+    if extension == 'docx':
+        from lxml import etree
+
+        try:
+            return docx_text(source)
+        except (zipfile.BadZipFile, etree.XMLSyntaxError):
+            return None
+    if not isinstance(source, bytes):
+        with open(source, 'rb') as text_file:
+            source = text_file.read()
+    return plain_text(source)
+
+
+_document_texts = OrderedDict()
+_document_texts_lock = threading.Lock()
+
+
+def document_text(document_bytes, extension='docx'):
+    """extract_text для готового документа в памяти с LRU по хэшу содержимого.
+
+    Попадание в render_cache отдает те же bytes, поэтому текст для индекса
+    повторно не разбирается: хэш заметно дешевле прохода lxml по XML.
+    """
+    key = (extension, hashlib.sha256(document_bytes).digest())
+    with _document_texts_lock:
+        if key in _document_texts:
+            _document_texts.move_to_end(key)
+            return _document_texts[key]
+    content = extract_text(document_bytes, extension)
+    with _document_texts_lock:
+        _document_texts[key] = content
+        if len(_document_texts) > DOCUMENT_TEXT_CACHE_SIZE:
+            _document_texts.popitem(last=False)
+    return content
+
+
+def ensure_search_index(engine):
+    with engine.begin() as connection:
+        connection.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS ReadyDocText "
+            "USING fts5(content, tokenize='unicode61 remove_diacritics 2')"
+        ))
+
+
+def index_document(session, ready_doc_id, content):
+    """Кладет текст документа в индекс в текущей транзакции session; пустой текст не индексируется."""
+    if not content:
+        return
+    # В режиме шардов индекс лежит в файле шарда документа, шард виден по id
+    bind_arguments = shard_bind_arguments(session, ready_doc_id)
+    options = {'bind_arguments': bind_arguments} if bind_arguments else {}
+    session.execute(text("DELETE FROM ReadyDocText WHERE rowid = :id"), {'id': ready_doc_id}, **options)
+    session.execute(text("INSERT INTO ReadyDocText(rowid, content) VALUES (:id, :content)"),
+                    {'id': ready_doc_id, 'content': content}, **options)
+
+
+def match_expression(query):
+    """Запрос пользователя -> выражение MATCH: все слова обязательны, каждое ищется по префиксу.
+
+    Синтаксис FTS5 пользователю не доступен, поэтому кавычки и операторы в
+    запросе не ломают поиск.
+    """
+    tokens = TOKEN_PATTERN.findall(query or '')
+    return ' '.join(f'"{token}"*' for token in tokens)
+
+
+def search_documents(session, query, limit=20, offset=0):
+    """Документы по убыванию релевантности (bm25) со сниппетами.
+
+    Возвращает (строки, есть ли следующая страница): общее число совпадений
+    не считаем, чтобы не проходить весь индекс на каждый запрос.
+    """
+    expression = match_expression(query)
+    if not expression:
+        return [], False
+    limit = max(1, min(limit, SEARCH_MAX_LIMIT))
+    offset = max(offset, 0)
+    statement = text(
+        "SELECT d.id, d.date, d.legalEntities, d.sum, d.document_number, "
+        "snippet(ReadyDocText, 0, '[', ']', '…', :tokens) AS snippet, "
+        "bm25(ReadyDocText) AS score "
+        "FROM ReadyDocText JOIN ReadyDoc AS d ON d.id = ReadyDocText.rowid "
+        "WHERE ReadyDocText MATCH :match "
+        "ORDER BY rank LIMIT :limit OFFSET :offset"
+    )
+    params = {'match': expression, 'tokens': SNIPPET_TOKENS, 'limit': limit + 1, 'offset': offset}
+
+    shards = shard_bind_arguments_all(session)
+    if len(shards) == 1:
+        options = {'bind_arguments': shards[0]} if shards[0] else {}
+        rows = session.execute(statement, params, **options).mappings().all()
+    else:
+        # Каждый шард отдает свои лучшие offset + limit + 1 строк, общий порядок - по bm25.
+        # Оценки шардов считаются по разной статистике слов, так что порядок приближенный
+        params.update(limit=offset + limit + 1, offset=0)
+        rows = [row for shard in shards
+                for row in session.execute(statement, params, bind_arguments=shard).mappings().all()]
+        rows = sorted(rows, key=lambda row: row['score'])[offset:offset + limit + 1]
+    return [dict(row) for row in rows[:limit]], len(rows) > limit
+
+
+def backfill(engine, root, batch_size=BACKFILL_BATCH_SIZE, output_dir=None):
+    """Индексирует файлы документов, которых еще нет в ReadyDocText.
+
+    Идет по ReadyDoc порциями по batch_size по возрастанию id и коммитит
+    каждую порцию, поэтому прерванный запуск можно просто повторить.
+    Относительные ссылки разрешаются от root. Индексируются только файлы
+    внутри output_dir (по умолчанию root/Ready_doc): у документов из
+    /process_document в link записан путь шаблона, а готовый файл не
+    сохранялся, и текст шаблона в индекс попасть не должен.
+    """
+    ensure_search_index(engine)
+    output_dir = os.path.realpath(output_dir or os.path.join(root, 'Ready_doc'))
+    indexed = skipped = 0
+    last_id = 0
+    while True:
+        with engine.begin() as connection:
+            rows = connection.execute(text(
+                "SELECT id, link FROM ReadyDoc "
+                "WHERE id > :last_id "
+                "AND NOT EXISTS (SELECT 1 FROM ReadyDocText WHERE ReadyDocText.rowid = ReadyDoc.id) "
+                "ORDER BY id LIMIT :batch_size"
+            ), {'last_id': last_id, 'batch_size': batch_size}).all()
+            if not rows:
+                return indexed, skipped
+            for ready_doc_id, link in rows:
+                last_id = ready_doc_id
+                path = link if not link or os.path.isabs(link) else os.path.join(root, link)
+                if path and not os.path.realpath(path).startswith(output_dir + os.sep):
+                    path = None
+                try:
+                    content = extract_text(path, os.path.splitext(path)[1]) if path else None
+                except OSError:
+                    content = None
+                if not content:
+                    skipped += 1
+                    continue
+                index_document(connection, ready_doc_id, content)
+                indexed += 1
+
+
+def main():
+    from Services.storage import PROJECT_ROOT, get_engine
+
+    parser = argparse.ArgumentParser(description='Полнотекстовый индекс ReadyDoc')
+    parser.add_argument('--backfill', action='store_true', help='проиндексировать существующие файлы')
+    parser.add_argument('--root', default=PROJECT_ROOT, help='каталог, от которого считаются относительные ссылки')
+    parser.add_argument('--batch-size', type=int, default=BACKFILL_BATCH_SIZE)
+    parser.add_argument('--output-dir', help='каталог готовых документов, по умолчанию <root>/Ready_doc')
+    args = parser.parse_args()
+
+    engine = get_engine()
+    # В режиме шардов индекс и документы лежат в файлах шардов
+    router = router_from_env(engine)
+    engines = data_engines(router) if router else [engine]
+    if args.backfill:
+        indexed = skipped = 0
+        for data_engine in engines:
+            engine_indexed, engine_skipped = backfill(data_engine, args.root, args.batch_size, args.output_dir)
+            indexed += engine_indexed
+            skipped += engine_skipped
+        print(f'Indexed {indexed} documents, skipped {skipped}')
+    else:
+        for data_engine in engines:
+            ensure_search_index(data_engine)
+
+
+if __name__ == '__main__':
+    main()
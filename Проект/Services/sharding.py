@@ -0,0 +1,555 @@
+"""Необязательное разнесение шаблонов и истории документов по партнерам.
+
+Если задан SHARD_DIR, шаблоны (DocTemp) и готовые документы (ReadyDoc вместе
+с их полнотекстовым индексом) каждого юрлица лежат в своем файле SQLite
+SHARD_DIR/shard_<n>.db. Основная БД становится каталогом: пользователи,
+справочники, счетчики номеров, сводка, очередь заданий и карта PartnerShard
+(юрлицо -> номер шарда).
+
+Маршрутизацию делает RoutedSession (horizontal_shard из SQLAlchemy), так что
+маршруты работают с ней как с обычной сессией: запрос с условием на юрлицо
+или id идет в один шард, остальные - во все шарды с объединением строк;
+новые записи пишутся в шард своего юрлица. id в шарде n начинаются с
+n << SHARD_ID_SHIFT, поэтому остаются уникальными во всей системе и по ним
+видно шард. Номера документов и сводка пишутся в каталог отдельными
+короткими транзакциями (catalog_transaction, defer_catalog_write), поэтому
+запись в шарды разных партнеров не ждет общей блокировки каталога.
+Перенести существующую БД (повторный запуск безопасен):
+    SHARD_DIR=DB/shards python -m Services.sharding --migrate [--prune]
+"""
+import argparse
+import logging
+import os
+import threading
+
+from sqlalchemy import (
+    Column, Index, Integer, MetaData, String, Table, column, event, func, inspect, insert, literal, select,
+    table, text,
+)
+from sqlalchemy.ext.horizontal_shard import ShardedSession
+from sqlalchemy.orm import scoped_session
+from sqlalchemy.sql import operators
+from sqlalchemy.sql import util as sql_util
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter, BooleanClauseList
+
+from Services.storage import PROJECT_ROOT, add_missing_columns, get_engine
+
+CATALOG = 'catalog'
+SHARD_ID_SHIFT = 40  # 2^40 записей на шард, а id остаются меньше 2^53 и точно передаются в JSON
+MIGRATE_BATCH_SIZE = 1000
+
+# Таблица -> колонка с юрлицом, по которой выбирается шард
+SHARD_KEYS = {'DocTemp': 'compName', 'ReadyDoc': 'legalEntities'}
+SEARCH_TABLE = 'ReadyDocText'  # Живет в шарде рядом с ReadyDoc, rowid = ReadyDoc.id
+
+# Относительный путь считаем от корня проекта, как и путь к основной БД
+SHARD_DIR = os.environ.get('SHARD_DIR') or None
+if SHARD_DIR and not os.path.isabs(SHARD_DIR):
+    SHARD_DIR = os.path.join(PROJECT_ROOT, SHARD_DIR)
+
+# Назначения шардов, сделанные в незакоммиченной транзакции сессии
+PENDING_KEY = 'pending_partner_shards'
+# Записи в каталог (сводка), отложенные до коммита сессии
+CATALOG_WRITES_KEY = 'pending_catalog_writes'
+
+logger = logging.getLogger(__name__)
+
+catalog_metadata = MetaData()
+
+partner_shard_table = Table(
+    "PartnerShard", catalog_metadata,
+    Column("legal_entity", String, primary_key=True),  # '' для документов без юрлица
+    Column("shard", Integer, nullable=False, unique=True),
+)
+
+
+def shard_name(number):
+    return f'shard_{number}'
+
+
+def shard_number(shard_id):
+    return int(shard_id.rsplit('_', 1)[1])
+
+
+def _partner_key(legal_entity):
+    return legal_entity or ''
+
+
+def _shard_table(source, metadata):
+    """Копия таблицы модели для шарда: без внешних ключей (справочники в каталоге) и с AUTOINCREMENT."""
+    copy = Table(
+        source.name, metadata,
+        *(Column(item.name, item.type, primary_key=item.primary_key, nullable=item.nullable)
+          for item in source.columns),
+        sqlite_autoincrement=True,
+    )
+    for index in source.indexes:
+        Index(index.name, *(copy.c[item.name] for item in index.columns), unique=index.unique)
+    return copy
+
+
+def _conjuncts(clause):
+    """Условия верхнего уровня AND: только по ним можно сузить выборку до шарда."""
+    if isinstance(clause, BooleanClauseList) and clause.operator is operators.and_:
+        for item in clause.clauses:
+            yield from _conjuncts(item)
+    elif clause is not None:
+        yield clause
+
+
+class ShardRouter:
+    """Карта юрлицо -> шард и движки шардов; один объект на процесс."""
+
+    def __init__(self, catalog_engine, shard_dir, metadata=None):
+        self.catalog_engine = catalog_engine
+        self.shard_dir = shard_dir
+        if metadata is None:
+            # Без моделей (миграция, CLI) берем схему из каталога
+            metadata = MetaData()
+            metadata.reflect(catalog_engine, only=list(SHARD_KEYS))
+        self.shard_metadata = MetaData()
+        for name in SHARD_KEYS:
+            _shard_table(metadata.tables[name], self.shard_metadata)
+
+        self._partners = {}  # Только закоммиченные назначения: карта не меняется, кэш не устаревает
+        self._prepared = set()
+        self._lock = threading.Lock()
+        os.makedirs(shard_dir, exist_ok=True)
+
+    def init_catalog(self):
+        catalog_metadata.create_all(self.catalog_engine)
+
+    def shard_path(self, number):
+        return os.path.join(self.shard_dir, f'{shard_name(number)}.db')
+
+    def engine(self, shard_id):
+        """Движок шарда; при первом обращении процесса досоздает схему файла."""
+        if shard_id == CATALOG:
+            return self.catalog_engine
+        number = shard_number(shard_id)
+        engine = get_engine('sqlite:///' + self.shard_path(number))
+        if number not in self._prepared:
+            with self._lock:
+                if number not in self._prepared:
+                    self._prepare(engine, number)
+                    self._prepared.add(number)
+        return engine
+
+    def _prepare(self, engine, number):
+        from Services.metrics import instrument_engine
+        from Services.search_service import ensure_search_index
+
+        instrument_engine(engine)
+        self.shard_metadata.create_all(engine)
+        # Оба приложения описывают ReadyDoc по-своему: колонки второго досоздаются здесь
+        add_missing_columns(engine, self.shard_metadata)
+        ensure_search_index(engine)
+        with engine.begin() as connection:
+            for name in SHARD_KEYS:
+                connection.execute(text(
+                    "INSERT INTO sqlite_sequence(name, seq) SELECT :name, :seq "
+                    "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = :name)"
+                ), {'name': name, 'seq': number << SHARD_ID_SHIFT})
+
+    def lookup(self, legal_entity):
+        """Номер шарда юрлица или None, если шарда у него еще нет."""
+        key = _partner_key(legal_entity)
+        number = self._partners.get(key)
+        if number is None:
+            with self.catalog_engine.connect() as connection:
+                number = connection.scalar(
+                    select(partner_shard_table.c.shard).where(partner_shard_table.c.legal_entity == key)
+                )
+            if number is not None:
+                self._partners[key] = number
+        return number
+
+    def assign(self, connection, legal_entity):
+        """Номер шарда юрлица; нового юрлица заносит в карту в транзакции connection.
+
+        Следующий номер берется одним INSERT ... SELECT под блокировкой записи
+        каталога, поэтому два процесса не выдадут один номер.
+        """
+        key = _partner_key(legal_entity)
+        connection.execute(insert(partner_shard_table).prefix_with('OR IGNORE').from_select(
+            ['legal_entity', 'shard'],
+            select(literal(key), func.coalesce(func.max(partner_shard_table.c.shard), 0) + 1),
+        ))
+        return connection.scalar(
+            select(partner_shard_table.c.shard).where(partner_shard_table.c.legal_entity == key)
+        )
+
+    def assign_now(self, legal_entity):
+        """assign в отдельной короткой транзакции каталога."""
+        number = self.lookup(legal_entity)
+        if number is None:
+            with self.catalog_engine.begin() as connection:
+                number = self.assign(connection, legal_entity)
+            self._partners[_partner_key(legal_entity)] = number
+        return number
+
+    def shard_for_new(self, session, legal_entity):
+        """Шард для новой записи сессии.
+
+        Новое юрлицо заносится в карту короткой транзакцией каталога, чтобы
+        блокировка записи каталога не держалась до коммита документа в шард;
+        если запись потом откатится, у юрлица останется пустой шард. Только
+        если сессия уже пишет в каталог (и держит его блокировку), юрлицо
+        попадает в карту в ее транзакции, вместе с этой записью.
+        """
+        key = _partner_key(legal_entity)
+        pending = session.info.setdefault(PENDING_KEY, {})
+        number = pending.get(key) or self.lookup(key)
+        if number is None:
+            connection = session.connection(bind_arguments={'shard_id': CATALOG})
+            # pysqlite открывает транзакцию только перед первой записью
+            if connection.connection.driver_connection.in_transaction:
+                number = pending[key] = self.assign(connection, key)
+            else:
+                number = self.assign_now(key)
+        return shard_name(number)
+
+    def shard_ids(self, session=None):
+        """Все шарды, включая назначенные в текущей транзакции session; без шардов - каталог."""
+        with self.catalog_engine.connect() as connection:
+            numbers = set(connection.scalars(select(partner_shard_table.c.shard)))
+        if session is not None:
+            numbers.update(session.info.get(PENDING_KEY, {}).values())
+        return [shard_name(number) for number in sorted(numbers)] or [CATALOG]
+
+    def _lookup_in(self, session, legal_entity):
+        if session is not None:
+            number = session.info.get(PENDING_KEY, {}).get(_partner_key(legal_entity))
+            if number is not None:
+                return number
+        return self.lookup(legal_entity)
+
+    def _id_shards(self, values):
+        numbers = {value >> SHARD_ID_SHIFT for value in values if isinstance(value, int)}
+        # Старые id, перенесенные миграцией, по номеру не различить
+        if not numbers or 0 in numbers:
+            return None
+        existing = [number for number in sorted(numbers) if os.path.exists(self.shard_path(number))]
+        return [shard_name(number) for number in existing] or [CATALOG]
+
+    def statement_shards(self, statement, session=None):
+        """Шарды, в которых нужно выполнить statement."""
+        if statement.is_dml:
+            tables = [statement.table]
+        else:
+            tables = sql_util.find_tables(statement, include_crud=True)
+        if not any(getattr(item, 'name', None) in SHARD_KEYS for item in tables):
+            return [CATALOG]
+
+        for criterion in _conjuncts(getattr(statement, 'whereclause', None)):
+            if not isinstance(criterion, BinaryExpression) or not isinstance(criterion.right, BindParameter):
+                continue
+            if criterion.operator not in (operators.eq, operators.in_op):
+                continue
+            left = criterion.left
+            table_name = getattr(getattr(left, 'table', None), 'name', None)
+            if table_name not in SHARD_KEYS:
+                continue
+            values = criterion.right.effective_value
+            if criterion.operator is operators.eq:
+                values = [values]
+            if left.name == SHARD_KEYS[table_name]:
+                numbers = {self._lookup_in(session, value) for value in values} - {None}
+                # У юрлица без шарда нет и записей: пустые таблицы каталога вернут пустой ответ
+                return [shard_name(number) for number in sorted(numbers)] or [CATALOG]
+            if left.name == 'id':
+                shards = self._id_shards(values)
+                if shards is not None:
+                    return shards
+        return self.shard_ids(session)
+
+    # Функции выбора для horizontal_shard
+
+    def shard_chooser(self, mapper, instance, clause=None):
+        key = SHARD_KEYS.get(mapper.local_table.name)
+        if key is None or instance is None:
+            return CATALOG
+        number = self.lookup(getattr(instance, key))
+        return CATALOG if number is None else shard_name(number)
+
+    def identity_chooser(self, mapper, primary_key, *, lazy_loaded_from, execution_options, bind_arguments, **kw):
+        if mapper.local_table.name not in SHARD_KEYS:
+            return [CATALOG]
+        if lazy_loaded_from is not None:
+            return [lazy_loaded_from.identity_token]
+        return self._id_shards(primary_key[:1]) or self.shard_ids()
+
+    def execute_chooser(self, context):
+        return self.statement_shards(context.statement, context.session)
+
+
+def _assign_new_instances(session, flush_context, instances):
+    router = session.router
+    for instance in session.new:
+        state = inspect(instance)
+        key = SHARD_KEYS.get(state.mapper.local_table.name)
+        if key is not None and state.identity_token is None:
+            state.identity_token = router.shard_for_new(session, getattr(instance, key))
+
+
+def _remember_assignments(session):
+    session.router._partners.update(session.info.pop(PENDING_KEY, {}))
+
+
+def _apply_catalog_writes(session):
+    writes = session.info.pop(CATALOG_WRITES_KEY, None)
+    if not writes:
+        return
+    try:
+        with session.router.catalog_engine.begin() as connection:
+            for write in writes:
+                write(connection)
+    except Exception:
+        # Документы уже в шардах; сводку догонит python -m Services.report_service --rebuild
+        logger.warning('Deferred catalog writes failed', exc_info=True)
+
+
+def _forget_assignments(session):
+    session.info.pop(PENDING_KEY, None)
+    session.info.pop(CATALOG_WRITES_KEY, None)
+
+
+class RoutedSession(ShardedSession):
+    """Сессия, которая сама выбирает шард для DocTemp и ReadyDoc; остальные таблицы - в каталоге."""
+
+    def __init__(self, router, db=None, **kwargs):
+        # db передает sessionmaker Flask-SQLAlchemy; маршрутизация его не использует
+        self.router = router
+        super().__init__(
+            shard_chooser=router.shard_chooser,
+            identity_chooser=router.identity_chooser,
+            execute_chooser=router.execute_chooser,
+            **kwargs,
+        )
+        event.listen(self, 'before_flush', _assign_new_instances)
+        event.listen(self, 'after_commit', _remember_assignments)
+        event.listen(self, 'after_commit', _apply_catalog_writes)
+        event.listen(self, 'after_rollback', _forget_assignments)
+
+    def get_bind(self, mapper=None, *, shard_id=None, instance=None, clause=None, **kw):
+        if shard_id is None:
+            if mapper is None and instance is None:
+                shard_id = CATALOG
+            else:
+                mapper = inspect(mapper) if mapper is not None else None
+                shard_id = self._choose_shard_and_assign(mapper, instance=instance, clause=clause)
+        return self.router.engine(shard_id)
+
+
+def route_sessions(session_factory, router):
+    """Переключает sessionmaker приложения на RoutedSession."""
+    session_factory.class_ = RoutedSession
+    session_factory.configure(router=router, bind=None)
+
+
+def _unwrap(session):
+    # db.session у Flask-SQLAlchemy и SessionLocal в main.py - scoped_session
+    return session() if isinstance(session, scoped_session) else session
+
+
+def session_router(session):
+    return getattr(_unwrap(session), 'router', None)
+
+
+def catalog_transaction(session):
+    """Отдельная короткая транзакция каталога или None без шардирования.
+
+    Блокировка записи у каталога одна на всех партнеров: если держать ее,
+    пока документ пишется в шард, записи разных партнеров снова идут по одной.
+    """
+    router = session_router(session)
+    return None if router is None else router.catalog_engine.begin()
+
+
+def defer_catalog_write(session, write):
+    """Откладывает write(connection) до коммита session; False без шардирования.
+
+    Запись выполняется короткой транзакцией каталога после того, как
+    документы закоммичены в шарды, а при откате сессии отбрасывается.
+    """
+    session = _unwrap(session)
+    if getattr(session, 'router', None) is None:
+        return False
+    session.info.setdefault(CATALOG_WRITES_KEY, []).append(write)
+    return True
+
+
+def shard_bind_arguments(session, item_id=None):
+    """bind_arguments для session.execute с сырым SQL по записи item_id; None без шардирования."""
+    router = session_router(session)
+    if router is None:
+        return None
+    shards = router._id_shards([item_id]) if item_id is not None else None
+    return {'shard_id': shards[0] if shards else CATALOG}
+
+
+def shard_bind_arguments_all(session):
+    """bind_arguments для каждого шарда сессии; [None], если шардирования нет."""
+    router = session_router(session)
+    if router is None:
+        return [None]
+    return [{'shard_id': shard_id} for shard_id in router.shard_ids(_unwrap(session))]
+
+
+def statement_engines(session, statement):
+    """Движки, по которым нужно пройти statement напрямую, минуя сессию (потоковая выгрузка)."""
+    router = session_router(session)
+    if router is None:
+        return [session.get_bind()]
+    return [router.engine(shard_id) for shard_id in router.statement_shards(statement, _unwrap(session))]
+
+
+def data_engines(router):
+    """Движки всех шардов: по ним пересчитываются сводка и поисковый индекс."""
+    return [router.engine(shard_id) for shard_id in router.shard_ids() if shard_id != CATALOG]
+
+
+def router_from_env(engine=None):
+    """ShardRouter по SHARD_DIR для CLI или None, если шардирование выключено."""
+    if not SHARD_DIR:
+        return None
+    router = ShardRouter(engine or get_engine(), SHARD_DIR)
+    router.init_catalog()
+    return router
+
+
+# Перенос существующей БД
+
+def _raw_table(name, columns):
+    # Колонки без типов: значения копируются как есть, старые даты строкой не ломают перенос
+    return table(name, *(column(item) for item in columns))
+
+
+def _copy_rows(router, name, batch_size):
+    target = router.shard_metadata.tables[name]
+    existing = {item['name'] for item in inspect(router.catalog_engine).get_columns(name)}
+    columns = [item.name for item in target.columns if item.name in existing]
+    source = _raw_table(name, columns)
+    shard_table = _raw_table(name, columns)
+    key = SHARD_KEYS[name]
+
+    copied = 0
+    with router.catalog_engine.connect() as connection:
+        result = connection.execution_options(yield_per=batch_size).execute(
+            select(*source.c).order_by(source.c.id)
+        )
+        for partition in result.mappings().partitions():
+            by_shard = {}
+            for row in partition:
+                by_shard.setdefault(router.assign_now(row[key]), []).append(dict(row))
+            for number, rows in by_shard.items():
+                with router.engine(shard_name(number)).begin() as shard:
+                    shard.execute(insert(shard_table).prefix_with('OR IGNORE'), rows)
+            copied += len(partition)
+    return copied
+
+
+def _copy_search_index(router, batch_size):
+    if not inspect(router.catalog_engine).has_table(SEARCH_TABLE):
+        return 0
+    copied = 0
+    with router.catalog_engine.connect() as connection:
+        result = connection.execution_options(yield_per=batch_size).execute(text(
+            "SELECT t.rowid AS id, t.content AS content, d.legalEntities AS legal_entity "
+            "FROM ReadyDocText AS t JOIN ReadyDoc AS d ON d.id = t.rowid ORDER BY t.rowid"
+        ))
+        for partition in result.mappings().partitions():
+            by_shard = {}
+            for row in partition:
+                by_shard.setdefault(router.assign_now(row['legal_entity']), []).append(
+                    {'id': row['id'], 'content': row['content']}
+                )
+            for number, rows in by_shard.items():
+                with router.engine(shard_name(number)).begin() as shard:
+                    shard.execute(text("DELETE FROM ReadyDocText WHERE rowid = :id"), rows)
+                    shard.execute(text("INSERT INTO ReadyDocText(rowid, content) VALUES (:id, :content)"), rows)
+            copied += len(partition)
+    return copied
+
+
+def _seed_document_counters(engine):
+    """Счетчики номеров из перенесенной истории: без ReadyDoc в каталоге allocate начал бы месяц с 1."""
+    inspector = inspect(engine)
+    if not inspector.has_table('DocumentCounter'):
+        return
+    if 'document_number' not in {item['name'] for item in inspector.get_columns('ReadyDoc')}:
+        return
+    with engine.begin() as connection:
+        connection.execute(text(
+            "INSERT INTO DocumentCounter(year, month, last_number) "
+            "SELECT CAST(strftime('%Y', date) AS INTEGER), CAST(strftime('%m', date) AS INTEGER), "
+            "max(document_number) FROM ReadyDoc "
+            "WHERE document_number IS NOT NULL AND strftime('%Y', date) IS NOT NULL "
+            "GROUP BY 1, 2 "
+            "ON CONFLICT(year, month) DO UPDATE SET last_number = max(last_number, excluded.last_number)"
+        ))
+
+
+def migrate(router, batch_size=MIGRATE_BATCH_SIZE):
+    """Копирует DocTemp, ReadyDoc и поисковый индекс из каталога в шарды порциями по batch_size.
+
+    Строки сохраняют прежние id и вставляются через INSERT OR IGNORE, поэтому
+    прерванный перенос можно просто запустить снова. Каталог не меняется,
+    кроме карты шардов и счетчиков номеров; удаляет перенесенное prune().
+    """
+    counts = {name: _copy_rows(router, name, batch_size) for name in SHARD_KEYS}
+    counts[SEARCH_TABLE] = _copy_search_index(router, batch_size)
+    _seed_document_counters(router.catalog_engine)
+    return counts
+
+
+def prune(router):
+    """Удаляет перенесенные строки из каталога, если каждое юрлицо полностью есть в своем шарде."""
+    for name, key in SHARD_KEYS.items():
+        source = _raw_table(name, ['id', key])
+        with router.catalog_engine.connect() as connection:
+            expected = connection.execute(
+                select(source.c[key], func.count()).group_by(source.c[key])
+            ).all()
+        for legal_entity, count in expected:
+            number = router.lookup(legal_entity)
+            if number is None:
+                raise RuntimeError(f'{name}: partner {legal_entity!r} has no shard, run --migrate first')
+            with router.engine(shard_name(number)).connect() as shard:
+                # Новые записи шарда имеют id от number << SHARD_ID_SHIFT, перенесенные - меньше
+                copied = shard.scalar(select(func.count()).select_from(source).where(
+                    func.coalesce(source.c[key], '') == _partner_key(legal_entity),
+                    source.c.id < 1 << SHARD_ID_SHIFT,
+                ))
+            if copied < count:
+                raise RuntimeError(f'{name}: {copied} of {count} rows of {legal_entity!r} copied, run --migrate again')
+
+    with router.catalog_engine.begin() as connection:
+        if inspect(connection).has_table(SEARCH_TABLE):
+            connection.execute(text("DELETE FROM ReadyDocText"))
+        for name in SHARD_KEYS:
+            connection.execute(text(f'DELETE FROM "{name}"'))
+    with router.catalog_engine.connect() as connection:
+        connection.execution_options(isolation_level='AUTOCOMMIT').execute(text('VACUUM'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Разнесение DocTemp и ReadyDoc по шардам партнеров')
+    parser.add_argument('--migrate', action='store_true', help='скопировать шаблоны и документы в шарды')
+    parser.add_argument('--prune', action='store_true', help='удалить перенесенные строки из каталога')
+    parser.add_argument('--batch-size', type=int, default=MIGRATE_BATCH_SIZE)
+    args = parser.parse_args()
+
+    router = router_from_env()
+    if router is None:
+        parser.error('SHARD_DIR is not set')
+    if args.migrate:
+        counts = migrate(router, args.batch_size)
+        print(', '.join(f'{name}: {count}' for name, count in counts.items()))
+    if args.prune:
+        prune(router)
+        print('Catalog pruned')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+from sqlalchemy import create_engine, event, inspect, text
+import os
+import threading
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Абсолютный путь: оба приложения работают с одним файлом независимо от текущего каталога
+DATABASE_URL = os.environ.get('DATABASE_URL') or 'sqlite:///' + os.path.join(PROJECT_ROOT, 'DB', 'db.db')
+
+BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS') or 30000)
+
+# WAL позволяет читать параллельно с записью, а busy_timeout заставляет писателей
+# подождать освобождения блокировки вместо немедленного "database is locked"
+SQLITE_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('busy_timeout', BUSY_TIMEOUT_MS),
+    ('temp_store', 'MEMORY'),
+    ('cache_size', -16000),  # 16 МБ страничного кэша на соединение
+)
+
+
+def is_sqlite_file(url):
+    return url.startswith('sqlite') and ':memory:' not in url and url.rstrip('/') not in ('sqlite:', 'sqlite')
+
+
+def engine_options(url=DATABASE_URL):
+    """Параметры create_engine; их же отдаем Flask-SQLAlchemy через SQLALCHEMY_ENGINE_OPTIONS."""
+    if not is_sqlite_file(url):
+        return {}
+    return {
+        'pool_size': 10,
+        'max_overflow': 20,
+        'pool_timeout': 30,
+        'connect_args': {'timeout': BUSY_TIMEOUT_MS / 1000, 'check_same_thread': False},
+    }
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in SQLITE_PRAGMAS:
+            cursor.execute(f'PRAGMA {name}={value}')
+    finally:
+        cursor.close()
+
+
+def configure_engine(engine):
+    """Подключает настройку PRAGMA к каждому новому соединению SQLite."""
+    if engine.dialect.name == 'sqlite' and not event.contains(engine, 'connect', set_sqlite_pragmas):
+        event.listen(engine, 'connect', set_sqlite_pragmas)
+    return engine
+
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def get_engine(url=DATABASE_URL):
+    """Один общий движок (и пул соединений) на процесс для каждого URL."""
+    with _engines_lock:
+        engine = _engines.get(url)
+        if engine is None:
+            engine = configure_engine(create_engine(url, echo=False, **engine_options(url)))
+            _engines[url] = engine
+        return engine
+
+
+def add_missing_columns(engine, metadata):
+    """create_all не трогает существующие таблицы: досоздаем в них новые колонки и индексы.
+
+    Добавляются только nullable-колонки без первичного ключа - то, что SQLite
+    умеет сделать через ALTER TABLE ADD COLUMN.
+    """
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing or column.primary_key or not column.nullable:
+                    continue
+                column_type = column.type.compile(engine.dialect)
+                connection.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}'))
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
@@ -0,0 +1,87 @@
+"""Манифест плейсхолдеров шаблона: какие поля есть, в каких частях и сколько раз.
+
+Строится один раз при загрузке шаблона и хранится в DocTemp.placeholder_manifest,
+поэтому запрос на рендеринг можно проверить, не открывая .docx.
+
+Поле шаблона - это маркер {{имя}} или заглушка из букв Х (ХХХ, хххх), которой
+размечены все шаблоны в Templates. Оба вида обязательны: документ с
+оставшейся заглушкой не готов. Заглушку можно заменять и вместе с соседним
+текстом ("№ ХХХ от"): ключ закрывает все заглушки, которые в нем есть.
+Ключи без маркеров и заглушек ("ФИО") по-прежнему заменяются как есть.
+"""
+import json
+import re
+
+from Services.search_service import iter_docx_paragraphs
+
+MANIFEST_VERSION = 2
+
+# Те же части, что обходит document_service при рендеринге
+TEMPLATE_PARTS = re.compile(r'^word/(document|header\d*|footer\d*|footnotes|endnotes|comments)\.xml$')
+MARKER_PATTERN = re.compile(r'\{\{\s*[^{}]+?\s*\}\}')
+FILLER_PATTERN = re.compile(r'(?<!\w)[Хх]{3,}(?!\w)')
+
+
+def is_marker(key):
+    return MARKER_PATTERN.fullmatch(key) is not None
+
+
+def key_fields(key):
+    """Поля шаблона, которые закрывает ключ запроса: сам маркер или заглушки внутри текста."""
+    return {key} if is_marker(key) else set(FILLER_PATTERN.findall(key))
+
+
+def build_manifest(source):
+    """Манифест .docx (путь или bytes): {"version", "placeholders": {имя: {"count", "parts", "required"}}}."""
+    placeholders = {}
+    for partname, text in iter_docx_paragraphs(source, TEMPLATE_PARTS):
+        for pattern in (MARKER_PATTERN, FILLER_PATTERN):
+            for match in pattern.finditer(text):
+                entry = placeholders.setdefault(match.group(), {'count': 0, 'parts': [], 'required': True})
+                entry['count'] += 1
+                if partname not in entry['parts']:
+                    entry['parts'].append(partname)
+    return {'version': MANIFEST_VERSION, 'placeholders': placeholders}
+
+
+def dump_manifest(manifest):
+    return json.dumps(manifest, ensure_ascii=False, sort_keys=True)
+
+
+def load_manifest(value):
+    if not value:
+        return None
+    manifest = json.loads(value)
+    if manifest.get('version', 1) < 2:
+        # Версия 1 считала заглушки необязательными; пересобирать .docx для этого не нужно
+        for entry in manifest['placeholders'].values():
+            entry['required'] = True
+        manifest['version'] = MANIFEST_VERSION
+    return manifest
+
+
+def validate_placeholders(manifest, placeholders):
+    """Сверяет значения запроса с манифестом.
+
+    Возвращает (ошибки, части): ошибки - {"missing": [...], "unknown": [...]}
+    или пустой dict; части - множество частей, где есть все запрошенные поля,
+    или None, если среди ключей есть текст без полей и сузить поиск нельзя.
+    Ключ с полем, которого нет в шаблоне, в документе не встретится - он unknown.
+    """
+    known = manifest['placeholders']
+    fields = {key: key_fields(key) for key in placeholders}
+    covered = set().union(*fields.values())
+    missing = sorted(name for name, entry in known.items() if entry['required'] and name not in covered)
+    unknown = sorted(key for key, names in fields.items() if names - known.keys())
+
+    errors = {}
+    if missing:
+        errors['missing'] = missing
+    if unknown:
+        errors['unknown'] = unknown
+
+    # Вхождение ключа содержит вхождение его поля, значит лежит в тех же частях
+    parts = None
+    if placeholders and all(fields.values()) and not unknown:
+        parts = frozenset(part for names in fields.values() for name in names for part in known[name]['parts'])
+    return errors, parts
@@ -0,0 +1,54 @@
+import hashlib
+import os
+import tempfile
+
+CHUNK_SIZE = 1024 * 1024  # Файл читается и пишется кусками по 1 МБ
+
+
+class BlobStore:
+    """Хранилище загруженных файлов с адресацией по содержимому.
+
+    Файл лежит по пути <root>/objects/ab/cd/<sha256>.<ext>: одинаковые загрузки
+    хранятся один раз, а файлы с одинаковыми именами больше не затирают друг друга.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.objects = os.path.join(root, 'objects')
+        self.incoming = os.path.join(root, 'incoming')
+        os.makedirs(self.objects, exist_ok=True)
+        os.makedirs(self.incoming, exist_ok=True)
+
+    def path_for(self, digest, extension):
+        name = f"{digest}.{extension}" if extension else digest
+        return os.path.join(self.objects, digest[:2], digest[2:4], name)
+
+    def save(self, stream, extension):
+        """Сохраняет поток, считая SHA-256 на лету.
+
+        Возвращает (хэш, путь, создан ли новый файл).
+        """
+        sha256 = hashlib.sha256()
+        fd, temp_path = tempfile.mkstemp(dir=self.incoming)
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                while True:
+                    chunk = stream.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    sha256.update(chunk)
+                    temp_file.write(chunk)
+
+            digest = sha256.hexdigest()
+            path = self.path_for(digest, extension)
+            if os.path.exists(path):
+                os.remove(temp_path)
+                return digest, path, False
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temp_path, path)  # Атомарно: читатели не увидят недописанный файл
+            return digest, path, True
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
@@ -1,12 +1,22 @@
 
-from flask import Flask, request, jsonify, abort
-from sqlalchemy import create_engine, Column, Integer, String, ForeignKey
-from sqlalchemy.orm import sessionmaker, relationship
+from flask import Flask, g, request, jsonify, send_file
+from sqlalchemy import Column, Integer, String, ForeignKey, Index, Text
+from sqlalchemy.orm import sessionmaker, scoped_session, relationship
 from sqlalchemy.ext.declarative import declarative_base
 import os
-from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash, check_password_hash
 import functools
+import zipfile
+from Services.storage import add_missing_columns, get_engine
+from Services.metrics import instrument_app
+from Services.upload_storage import BlobStore
+from Services.lookup_cache import LookupCache, MISSING
+from Services.admission import AdmissionLimiter, limit_concurrency
+from Services.auth_service import CredentialCache, bearer_token, issue_token, load_secret_key, verify_token
+from Services.report_service import ensure_summary, parse_document_date, record_document
+from Services.search_service import ensure_search_index, extract_text, index_document
+from Services.sharding import SHARD_DIR, ShardRouter, route_sessions
+from Services.template_manifest import build_manifest, dump_manifest, load_manifest
 
 
 app = Flask(__name__)
@@ -15,15 +25,41 @@ UPLOAD_FOLDER = './Ready_doc'
 ALLOWED_EXTENSIONS = {'docx', 'pdf', 'txt'}
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+app.config['SECRET_KEY'] = load_secret_key()  # SECRET_KEY или ключ развертывания из DB/secret_key
+# За nginx/Apache файл отдает сам веб-сервер через X-Sendfile, иначе - wsgi.file_wrapper (sendfile)
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE', '').lower() in ('1', 'true', 'yes')
+DOWNLOAD_MAX_AGE = 24 * 3600  # Файлы адресуются по содержимому и не меняются
+
+credential_cache = CredentialCache(app.config['SECRET_KEY'])
+# Загрузки пишут файлы и считают хэши: ограничиваем их отдельно от дешевых маршрутов
+upload_limiter = AdmissionLimiter(
+    'upload',
+    max_concurrent=int(os.environ.get('UPLOAD_CONCURRENCY') or 4),
+    max_queue=int(os.environ.get('UPLOAD_QUEUE_SIZE') or 16),
+    max_wait=float(os.environ.get('UPLOAD_QUEUE_TIMEOUT') or 10),
+    per_user=int(os.environ.get('UPLOAD_PER_USER') or 0) or None,
+)
+blob_store = BlobStore(UPLOAD_FOLDER)  # Каталоги создаются один раз при старте, а не на каждый запрос
 
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
-DATABASE_URL = "sqlite:///./DB/db.db"
-engine = create_engine(DATABASE_URL, echo=False)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+def file_extension(filename):
+    return filename.rsplit('.', 1)[1].lower()
+
+
+engine = get_engine()  # Общий с Document_api движок: WAL, busy_timeout, пул соединений
+# Одна сессия на запрос: token_required и сам маршрут получают один и тот же объект
+SessionLocal = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=engine))
+
+# Гистограммы задержек, счетчики SQL и /metrics; порог медленных запросов и доля профилирования из окружения
+instrument_app(
+    app, engine,
+    slow_request_ms=float(os.environ['SLOW_REQUEST_MS']) if os.environ.get('SLOW_REQUEST_MS') else None,
+    profile_sample_rate=float(os.environ.get('PROFILE_SAMPLE_RATE') or 0),
+)
 Base = declarative_base()
 
 
@@ -52,6 +88,11 @@ class ReadyDoc(Base):
     legalEntities = Column(String, ForeignKey("LegalEntities.name"))
     signatories = Column(String)
     link = Column(String)
+    content_hash = Column(String(64), index=True)  # SHA-256 загруженного файла
+
+    __table_args__ = (
+        Index("ix_ReadyDoc_legalEntities_date", "legalEntities", "date"),
+    )
 
 
 class DocTemp(Base):
@@ -60,6 +101,8 @@ class DocTemp(Base):
     compName = Column(String, ForeignKey("LegalEntities.name"))
     docType = Column(String, ForeignKey("Doctype.type"))
     link = Column(String)
+    content_hash = Column(String(64), index=True)  # SHA-256 загруженного файла
+    placeholder_manifest = Column(Text)  # JSON, см. Services/template_manifest.py
 
     legal_entity = relationship("LegalEntities", backref="templates")
     doctype = relationship("Doctype", backref="templates")
@@ -85,6 +128,15 @@ class Users(Base):
 
 
 Base.metadata.create_all(bind=engine)
+add_missing_columns(engine, Base.metadata)
+ensure_summary(engine)
+ensure_search_index(engine)
+
+# SHARD_DIR: шаблоны и документы каждого юрлица в своем файле, основная БД - каталог (Services/sharding.py)
+shard_router = ShardRouter(engine, SHARD_DIR, Base.metadata) if SHARD_DIR else None
+if shard_router:
+    shard_router.init_catalog()
+    route_sessions(SessionLocal.session_factory, shard_router)
 
 
 def get_db():
@@ -95,26 +147,49 @@ def get_db():
         db.close()
 
 
+@app.teardown_appcontext
+def remove_session(exception=None):
+    SessionLocal.remove()
+
+
 def token_required(f):
     @functools.wraps(f)
     def decorated(*args, **kwargs):
+        # Подписанный токен из /login проверяется без обращения к БД
+        token = bearer_token(request)
+        if token:
+            g.username = verify_token(token, app.config['SECRET_KEY'])
+            if not g.username:
+                return jsonify({'message': 'Invalid or expired token'}), 401
+            return f(*args, **kwargs)
+
         auth = request.authorization
         if not auth or not auth.username or not auth.password:
             return jsonify({'message': 'Authentication required'}), 401
 
+        # Запрос пользователя дешевый, дорого хэширование пароля: его и пропускает кэш
         db = SessionLocal()
         try:
             user = db.query(Users).filter_by(username=auth.username).first()
-            if not user or not user.check_password(auth.password):
+            if not user:
                 return jsonify({'message': 'Invalid credentials'}), 401
+            if not credential_cache.check(auth.username, auth.password, user.password_hash):
+                if not user.check_password(auth.password):
+                    return jsonify({'message': 'Invalid credentials'}), 401
+                credential_cache.add(auth.username, auth.password, user.password_hash)
         finally:
             db.close()
 
+        g.username = auth.username
         return f(*args, **kwargs)
 
     return decorated
 
 
+# Ставится после token_required: слоты делятся по пользователям
+upload_limited = limit_concurrency(lambda: upload_limiter, lambda: g.get('username') or request.remote_addr)
+
+
 @app.route('/login', methods=['POST'])
 def login():
     auth = request.authorization
@@ -127,7 +202,8 @@ def login():
         if not user or not user.check_password(auth.password):
             return jsonify({'message': 'Invalid credentials'}), 401
 
-        return jsonify({'message': 'Login successful'})
+        token = issue_token(user.username, app.config['SECRET_KEY'])
+        return jsonify({'message': 'Login successful', 'token': token, 'token_type': 'Bearer'})
     finally:
         db.close()
 
@@ -160,56 +236,71 @@ def create_user():
         db.close()
 
 
+DOCUMENT_TYPE_MAPPING = {
+    "заявка": "Заказ",
+    "заказ": "Заказ",
+    "акт": "Акт",
+    "отчёт": "Отчет"
+}
+
+# (компания, тип документа) -> ответ со ссылкой и манифестом шаблона или None, если для промаха
+# компания и тип документа уже заведены; сам промах по кэшу не отдается
+template_cache = LookupCache()
+
+
 @app.route("/get_template", methods=["POST"])
 @token_required
 def get_template():
+    data = request.get_json()
+    user_input_type = data.get("document_type", "").strip().lower()
+    user_input_company = data.get("company_name", "").strip()
+    user_input_director = data.get("director_name", "").strip()
+
+    document_type = DOCUMENT_TYPE_MAPPING.get(user_input_type, user_input_type.capitalize())
+    cache_key = (user_input_company, document_type)
+
+    cached = template_cache.get(cache_key)
+    if cached is not MISSING and cached is not None:
+        return jsonify(cached)
+
     db = SessionLocal()
     try:
-        data = request.get_json()
-        user_input_type = data.get("document_type", "").strip().lower()
-        user_input_company = data.get("company_name", "").strip()
-        user_input_director = data.get("director_name", "").strip()
-
-        document_type_mapping = {
-            "заявка": "Заказ",
-            "заказ": "Заказ",
-            "акт": "Акт",
-            "отчёт": "Отчет"
-        }
-        document_type = document_type_mapping.get(user_input_type, user_input_type.capitalize())
-
-        template = db.query(DocTemp).join(Doctype).join(LegalEntities).filter(
-            LegalEntities.name == user_input_company,
-            Doctype.type == document_type
+        # Промах каждый раз проверяем по БД: шаблон мог загрузить другой процесс
+        template = db.query(DocTemp).filter(
+            DocTemp.compName == user_input_company,
+            DocTemp.docType == document_type
         ).first()
 
         if template:
-            return jsonify({"template_link": template.link})
-        else:
-            company = db.query(LegalEntities).filter(LegalEntities.name == user_input_company).first()
-            if not company:
-                new_company = LegalEntities(name=user_input_company, director=user_input_director)
-                db.add(new_company)
-                db.commit()
-            else:
-                if "director_name" in data and data["director_name"]:
-                    company.director = data["director_name"]
-                    db.commit()
-
-            doctype = db.query(Doctype).filter(Doctype.type == document_type).first()
-            if not doctype:
-                new_doctype = Doctype(type=document_type)
-                db.add(new_doctype)
-                db.commit()
+            result = {"template_link": template.link, "manifest": load_manifest(template.placeholder_manifest)}
+            template_cache.set(cache_key, result)
+            return jsonify(result)
 
+        # None в кэше: компания и тип документа уже заведены, без нового директора писать нечего
+        if cached is None and not user_input_director:
             return jsonify({"message": "Шаблон не найден. Необходимо создать шаблон вручную."})
 
+        # Компанию и тип документа заводим одной транзакцией
+        company = db.get(LegalEntities, user_input_company)
+        if not company:
+            db.add(LegalEntities(name=user_input_company, director=user_input_director))
+        elif user_input_director:
+            company.director = user_input_director
+
+        if not db.get(Doctype, document_type):
+            db.add(Doctype(type=document_type))
+        db.commit()
+        template_cache.set(cache_key, None)
+
+        return jsonify({"message": "Шаблон не найден. Необходимо создать шаблон вручную."})
+
     finally:
         db.close()
 
 
 @app.route("/add_signed_document", methods=["POST"])
 @token_required
+@upload_limited
 def add_signed_document():
     db = SessionLocal()
     try:
@@ -222,14 +313,6 @@ def add_signed_document():
             return jsonify({"error": "No selected file"}), 400
 
         if file and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
-
-            if not os.path.exists(app.config['UPLOAD_FOLDER']):
-                os.makedirs(app.config['UPLOAD_FOLDER'])
-
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(filepath)
-
             date = request.form.get("date")
             legalEntities = request.form.get("legalEntities")
             signatories = request.form.get("signatories")
@@ -239,6 +322,14 @@ def add_signed_document():
             if not hours_worked_str or not employee_name:
                 return jsonify({"error": "Missing hours_worked or employee_name value"}), 400
 
+            # Дату храним в ISO: так по ней работают индексы и сводка по месяцам.
+            # Нет даты или ее не разобрать - документ принимаем как раньше, но без сводки
+            try:
+                date = parse_document_date(date).isoformat()
+                summarized = True
+            except ValueError:
+                summarized = False
+
             try:
                 hours_worked = float(hours_worked_str)
             except ValueError:
@@ -251,15 +342,24 @@ def add_signed_document():
             hourly_rate = employee.rate
             sum = int(hourly_rate * hours_worked)
 
+            # Файл сохраняем только после проверки полей формы
+            content_hash, filepath, _ = blob_store.save(file.stream, file_extension(file.filename))
+
             new_doc = ReadyDoc(
                 date=date,
                 sum=sum,
                 legalEntities=legalEntities,
                 signatories=signatories,
-                link=filepath
+                link=filepath,
+                content_hash=content_hash
             )
 
             db.add(new_doc)
+            if summarized:
+                record_document(db, date, legalEntities, sum)
+            db.flush()
+            # Текст берем из уже сохраненного файла: поток формы прочитан до конца
+            index_document(db, new_doc.id, extract_text(filepath, file_extension(file.filename)))
             db.commit()
 
             return jsonify({"message": "Документ успешно добавлен."}), 201
@@ -278,6 +378,7 @@ def add_signed_document():
 
 @app.route("/create_template", methods=["POST"])
 @token_required
+@upload_limited
 def create_template():
     db = SessionLocal()
     try:
@@ -290,14 +391,6 @@ def create_template():
             return jsonify({"error": "No selected file"}), 400
 
         if file and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
-
-            if not os.path.exists(app.config['UPLOAD_FOLDER']):
-                os.makedirs(app.config['UPLOAD_FOLDER'])
-
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(filepath)
-
             company_name = request.form.get("company_name")
             document_type = request.form.get("document_type")
 
@@ -310,14 +403,27 @@ def create_template():
             if not doctype:
                 return jsonify({"error": "Document type not found"}), 400
 
+            content_hash, filepath, _ = blob_store.save(file.stream, file_extension(file.filename))
+
+            # Плейсхолдеры ищем один раз при загрузке, а не при каждом рендеринге
+            manifest = None
+            if file_extension(file.filename) == 'docx':
+                try:
+                    manifest = dump_manifest(build_manifest(filepath))
+                except zipfile.BadZipFile:
+                    return jsonify({"error": "Invalid docx file"}), 400
+
             new_template = DocTemp(
                 compName=company_name,
                 docType=document_type,
-                link=filepath
+                link=filepath,
+                content_hash=content_hash,
+                placeholder_manifest=manifest
             )
 
             db.add(new_template)
             db.commit()
+            template_cache.invalidate((company_name, document_type))
 
             return jsonify({"message": "Шаблон успешно создан."}), 201
         else:
@@ -332,5 +438,73 @@ def create_template():
         db.close()
 
 
+# (таблица, id) -> (путь к файлу, SHA-256) или None, если файла нет
+download_cache = LookupCache()
+
+
+def stored_file(model, item_id):
+    """Путь и хэш файла записи; отдаем только файлы из UPLOAD_FOLDER."""
+    key = (model.__tablename__, item_id)
+    entry = download_cache.get(key)
+    if entry is not MISSING:
+        return entry
+
+    db = SessionLocal()
+    try:
+        item = db.get(model, item_id)
+        entry = None
+        if item and item.link:
+            path = os.path.realpath(item.link)
+            root = os.path.realpath(UPLOAD_FOLDER)
+            if path.startswith(root + os.sep) and os.path.isfile(path):
+                entry = (path, item.content_hash)
+    finally:
+        db.close()
+    # Промах не кэшируем: запись или файл могут появиться сразу после 404
+    if entry is not None:
+        download_cache.set(key, entry)
+    return entry
+
+
+def send_stored_file(model, item_id):
+    entry = stored_file(model, item_id)
+    if entry is None:
+        return jsonify({"error": "File not found"}), 404
+    path, content_hash = entry
+
+    # Повторный запрос с тем же ETag не открывает файл вовсе
+    if content_hash and content_hash in request.if_none_match:
+        response = app.response_class(status=304)
+        response.set_etag(content_hash)
+        response.cache_control.private = True
+        response.cache_control.max_age = DOWNLOAD_MAX_AGE
+        return response
+
+    # conditional=True: If-None-Match, If-Modified-Since и Range обрабатывает werkzeug
+    response = send_file(path, conditional=True, etag=content_hash or True, max_age=DOWNLOAD_MAX_AGE,
+                         download_name=os.path.basename(path))
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
+
+
+@app.route("/ready_docs/<int:doc_id>/file", methods=["GET"])
+@token_required
+def download_ready_doc(doc_id):
+    return send_stored_file(ReadyDoc, doc_id)
+
+
+@app.route("/templates/<int:template_id>/file", methods=["GET"])
+@token_required
+def download_template(template_id):
+    return send_stored_file(DocTemp, template_id)
+
+
+@app.route("/admission_stats", methods=["GET"])
+@token_required
+def admission_stats():
+    return jsonify(upload_limiter.stats())
+
+
 if __name__ == "__main__":
     app.run(debug=True)